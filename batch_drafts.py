@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# --- BATCH DRAFTS ---
+# Generates a month's drafts without the Streamlit page: every selected theme in
+# the configured segments that has no EmailDraft yet is drafted on a bounded
+# worker pool and written back to Airtable in bulk PATCHes. Each draft is
+# checkpointed to a local JSONL file the moment it arrives, so an interrupted
+# run picks up where it stopped: drafts already written are skipped and drafts
+# generated but not yet written are sent without calling OpenAI again. A run
+# that finishes without failures removes its checkpoint.
+# Reads .streamlit/secrets.toml from the working directory, like the app.
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_WORKERS = 4
+
+
+def checkpoint_path(month):
+    return os.path.join(".cache", f"batch-drafts-{month.replace(' ', '-').lower()}.jsonl")
+
+
+def load_checkpoint(path):
+    # {record_id: {"draft": ..., "written": bool}}
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by an interruption
+            state = entries.setdefault(entry["id"], {"draft": None, "written": False})
+            if "draft" in entry:
+                state["draft"] = entry["draft"]
+            if entry.get("written"):
+                state["written"] = True
+    return entries
+
+
+class Checkpoint:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.entries = load_checkpoint(path)
+        self.file = open(path, "a")
+
+    def append(self, entry):
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+    def drafted(self, record_id, draft):
+        self.entries[record_id] = {"draft": draft, "written": False}
+        self.append({"id": record_id, "draft": draft})
+
+    def written(self, record_id):
+        self.entries[record_id]["written"] = True
+        self.append({"id": record_id, "written": True})
+
+    def unwritten(self):
+        return {record_id: e["draft"] for record_id, e in self.entries.items() if e["draft"] and not e["written"]}
+
+    def close(self):
+        self.file.close()
+
+
+def load_themes(app, month, segments, overwrite):
+    formula = f"AND({{Month}} = '{month}', {{Status}} = 'selected')"
+    return [
+        record for record in app.iter_airtable_records(formula, fields=app.THEME_FIELDS)
+        if record["fields"].get("Segment") in segments
+        and (overwrite or not record["fields"].get("EmailDraft"))
+    ]
+
+
+def flush(app, checkpoint, pending, result):
+    results = app.batch_update_records({record_id: {"EmailDraft": draft} for record_id, draft in pending.items()})
+    for record_id, ok in results.items():
+        if ok:
+            checkpoint.written(record_id)
+            result["saved"] += 1
+        else:
+            result["failed"].append(record_id)
+    pending.clear()
+
+
+def run_batch(app, month, segments, workers, overwrite=False):
+    checkpoint = Checkpoint(checkpoint_path(month))
+    result = {"saved": 0, "failed": []}
+    try:
+        # Drafts paid for by an earlier, interrupted run go out first
+        resumed = checkpoint.unwritten()
+        if resumed:
+            print(f"Writing {len(resumed)} draft(s) left over from an earlier run")
+            flush(app, checkpoint, dict(resumed), result)
+        # Drafts written by earlier runs need no skipping: load_themes already leaves out
+        # themes with a draft, unless --overwrite asks for them again
+        themes = [t for t in load_themes(app, month, segments, overwrite) if t["id"] not in resumed]
+        print(f"{month}: {len(themes)} theme(s) to draft across {', '.join(segments)}")
+        pending = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(
+                    app.generate_email_draft,
+                    t["fields"]["Subject"], t["fields"]["Description"], t["fields"]["Segment"],
+                ): t
+                for t in themes
+            }
+            try:
+                for future in as_completed(futures):
+                    theme = futures[future]
+                    label = f"{theme['fields']['Segment']}: {theme['fields']['Subject']}"
+                    try:
+                        draft = future.result()
+                    except Exception as e:
+                        print(f"  ✗ {label} ({e})")
+                        result["failed"].append(theme["id"])
+                        continue
+                    checkpoint.drafted(theme["id"], draft)
+                    pending[theme["id"]] = draft
+                    print(f"  ✓ {label}")
+                    if len(pending) >= app.AIRTABLE_BATCH_SIZE:
+                        flush(app, checkpoint, pending, result)
+            except KeyboardInterrupt:
+                pool.shutdown(wait=False, cancel_futures=True)
+                print("Interrupted; writing the drafts generated so far")
+                raise
+            finally:
+                if pending:
+                    flush(app, checkpoint, pending, result)
+    finally:
+        checkpoint.close()
+    # A clean run leaves nothing to resume
+    if not result["failed"]:
+        os.remove(checkpoint.path)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate and save a month's email drafts without the app.")
+    parser.add_argument("--month", help='e.g. "October 2026" (default: the current month in Brisbane)')
+    parser.add_argument("--segment", action="append", help="limit to this segment (repeatable)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="concurrent OpenAI requests")
+    parser.add_argument("--overwrite", action="store_true", help="redraft themes that already have a draft")
+    args = parser.parse_args()
+
+    sys.path.insert(0, APP_DIR)
+    import streamlit_app as app
+
+    app.init_headless()
+
+    month = args.month or app.get_month()
+    segments = args.segment or app.SEGMENTS
+    unknown = [s for s in segments if s not in app.PERSONAS]
+    if unknown:
+        parser.error(f"unknown segment(s): {', '.join(unknown)}")
+    try:
+        result = run_batch(app, month, segments, args.workers, args.overwrite)
+    except KeyboardInterrupt:
+        print("Stopped. Run the same command again to resume.")
+        sys.exit(130)
+    print(f"Done: {result['saved']} saved, {len(result['failed'])} failed")
+    sys.exit(1 if result["failed"] else 0)
@@ -0,0 +1,383 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from smtp_sink import SMTPSink
+
+# --- OFFLINE BENCHMARK ---
+# Runs the app's real helpers against local stand-ins for Airtable, OpenAI and
+# Mailchimp (one HTTP server, routed by path prefix) and the SMTP sink. The
+# stand-ins add configurable latency, 5xx errors and 429s. For every user
+# action the report gives requests made, p50/p95 latency and bytes on the
+# wire (HTTP plus SMTP message bytes). Results are saved as JSON and can be
+# checked against a baseline.
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(APP_DIR, "bench_baseline.json")
+DEFAULT_RUNS = 20
+LATENCY_TOLERANCE = 0.5  # allowed p95 growth over the baseline
+LATENCY_SLACK_MS = 10
+BYTES_TOLERANCE = 0.1  # allowed growth in bytes per action over the baseline
+DRAFT_TEXT = "Hi *|FNAME|*\n\n" + "\n\n".join(
+    "Most people leave more money unstructured than they think." for _ in range(40)
+) + "\n\nWarm regards,\nShane\n\nP.S. My diary is open if you'd like a chat."
+
+
+class FakeServices(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.02, error_rate=0.0, rate_limit_rate=0.0, seed=0):
+        super().__init__(("127.0.0.1", 0), FakeHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.records = {}
+        self.campaigns = 0
+        self.action = None
+        self.stats = {}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def fault(self):
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+    def record(self, sent, received):
+        with self.lock:
+            if self.action is None:
+                return
+            stats = self.stats.setdefault(self.action, {"requests": 0, "bytes": 0})
+            stats["requests"] += 1
+            stats["bytes"] += sent + received
+
+    def seed_records(self, month, segments, per_segment):
+        for segment in segments:
+            for i in range(per_segment):
+                record_id = f"rec{len(self.records) + 1:05d}"
+                self.records[record_id] = {
+                    "id": record_id,
+                    "createdTime": "2026-01-01T00:00:00.000Z",
+                    "modified": time.time(),
+                    "fields": {
+                        "Segment": segment,
+                        "Month": month,
+                        "Subject": f"{segment} theme {i + 1}",
+                        "Description": "Why waiting to simplify your accounts costs more than it seems.",
+                        "Status": "pending",
+                    },
+                }
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(len(self.path) + self.request_size, len(body))
+
+    def dispatch(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        self.request_size = len(raw)
+        body = json.loads(raw) if raw else {}
+        time.sleep(self.server.latency)
+        fault = self.server.fault()
+        if fault == 429:
+            return self.reply(429, {"error": "RATE_LIMITED"}, {"Retry-After": "0"})
+        if fault == 500:
+            return self.reply(500, {"error": "SERVER_ERROR"})
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts[0] == "airtable":
+            return self.airtable(method, parts[4:], parse_qs(url.query), body)
+        if parts[0] == "openai":
+            return self.openai(body)
+        if parts[0] == "mailchimp":
+            return self.mailchimp(method, parts[3:], body)
+        self.reply(404, {"error": "NOT_FOUND"})
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def airtable(self, method, parts, query, body):
+        # parts is what follows /airtable/v0/<base>/<table>
+        records = self.server.records
+        public = lambda r: {"id": r["id"], "createdTime": r["createdTime"], "fields": r["fields"]}
+        if method == "GET":
+            matches = sorted(records.values(), key=lambda r: r["id"])
+            formula = query.get("filterByFormula", [""])[0]
+            if "LAST_MODIFIED_TIME" in formula:
+                since = formula.split("'")[1]
+                since = time.mktime(time.strptime(since, "%Y-%m-%dT%H:%M:%S.000Z")) - time.timezone
+                matches = [r for r in matches if r["modified"] > since]
+            start = int(query.get("offset", ["0"])[0])
+            size = int(query.get("pageSize", ["100"])[0])
+            page = {"records": [public(r) for r in matches[start:start + size]]}
+            if start + size < len(matches):
+                page["offset"] = str(start + size)
+            return self.reply(200, page)
+        if method == "PATCH":
+            updates = body["records"] if not parts else [{"id": parts[0], "fields": body["fields"]}]
+            out = []
+            for update in updates:
+                record = records[update["id"]]
+                record["fields"].update(update["fields"])
+                record["modified"] = time.time()
+                out.append(public(record))
+            return self.reply(200, {"records": out} if not parts else out[0])
+        if method == "POST":
+            out = []
+            for new in body["records"]:
+                record_id = f"rec{len(records) + 1:05d}"
+                records[record_id] = {
+                    "id": record_id, "createdTime": "2026-01-01T00:00:00.000Z",
+                    "modified": time.time(), "fields": new["fields"],
+                }
+                out.append(public(records[record_id]))
+            return self.reply(200, {"records": out})
+        self.reply(404, {"error": "NOT_FOUND"})
+
+    def openai(self, body):
+        prompt_chars = sum(len(m["content"]) for m in body["messages"])
+        self.reply(200, {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": DRAFT_TEXT},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_chars // 4,
+                "completion_tokens": len(DRAFT_TEXT) // 4,
+                "total_tokens": (prompt_chars + len(DRAFT_TEXT)) // 4,
+                "prompt_tokens_details": {"cached_tokens": 1024},
+            },
+        })
+
+    def mailchimp(self, method, parts, body):
+        # parts is what follows /mailchimp/<prefix>/3.0
+        if method == "POST" and parts == ["campaigns"]:
+            with self.server.lock:
+                self.server.campaigns += 1
+                campaign_id = f"camp{self.server.campaigns}"
+            return self.reply(200, {"id": campaign_id, **body})
+        if parts[:1] == ["campaigns"] and method in ("PATCH", "PUT"):
+            return self.reply(200, {"id": parts[1]})
+        self.reply(404, {"error": "NOT_FOUND"})
+
+
+def percentile(values, pct):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[pct - 1]
+
+
+def run_action(services, sink, name, action, runs, setup=None):
+    latencies = []
+    errors = 0
+    smtp_before = dict(sink.stats)
+    for _ in range(runs):
+        services.action = None
+        if setup:
+            setup()
+        services.action = name
+        start = time.perf_counter()
+        try:
+            action()
+        except Exception:
+            errors += 1
+        latencies.append((time.perf_counter() - start) * 1000)
+    services.action = None
+    stats = services.stats.get(name, {"requests": 0, "bytes": 0})
+    return {
+        "runs": runs,
+        "errors": errors,
+        "requests_per_action": stats["requests"] / runs,
+        "bytes_per_action": (stats["bytes"] + sink.stats["bytes"] - smtp_before["bytes"]) / runs,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "smtp_connections": sink.stats["connections"] - smtp_before["connections"],
+        "smtp_messages": sink.stats["messages"] - smtp_before["messages"],
+    }
+
+
+def write_secrets(workdir, sink):
+    secrets = {
+        "AIRTABLE_PAT": "bench", "AIRTABLE_BASE_ID": "appBench", "OPENAI_API_KEY": "bench",
+        "SMTP_USERNAME": "bench@example.com", "REVIEWER_EMAIL": "reviewer@example.com",
+        "NOTIFY_EMAIL": "notify@example.com", "MAILCHIMP_API_KEY": "bench-us1",
+        "MAILCHIMP_SERVER_PREFIX": "us1", "MAILCHIMP_AUDIENCE_ID": "aud1",
+        "MAILCHIMP_TAG_ID_PRE_RETIREES": "1", "MAILCHIMP_TAG_ID_RETIREES": "2",
+        "SMTP_HOST": "127.0.0.1", "SMTP_PORT": str(sink.port), "SMTP_STARTTLS": "false",
+    }
+    os.makedirs(os.path.join(workdir, ".streamlit"))
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w") as f:
+        for key, value in secrets.items():
+            f.write(f'{key} = "{value}"\n')
+
+
+def run_benchmark(runs, latency, error_rate, rate_limit_rate, smtp_delay, themes):
+    services = FakeServices(latency, error_rate, rate_limit_rate).start()
+    sink = SMTPSink("127.0.0.1", 0, smtp_delay).start()
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    write_secrets(workdir, sink)
+    os.chdir(workdir)
+    os.environ["OPENAI_BASE_URL"] = f"{services.url}/openai/v1"
+    sys.path.insert(0, APP_DIR)
+
+    import streamlit_app as app
+
+    # Drive the mirror by hand so a background sync can't land inside a timed action
+    mirror = app.init_headless()
+    app.AIRTABLE_API_URL = f"{services.url}/airtable/v0"
+    app.MAILCHIMP_API_URL = f"{services.url}/mailchimp/{{server_prefix}}/3.0"
+    services.seed_records(app.get_month(), app.SEGMENTS, themes)
+
+    services.action = "mirror_full_sync"
+    mirror.sync(full=True)
+    services.action = None
+
+    segment = app.SEGMENTS[0]
+    pending = iter(r["id"] for r in app.fetch_pending_themes(segment) for _ in range(runs))
+    campaign = {}
+
+    def select_one():
+        app.update_status(segment, next(pending))
+
+    def push_new():
+        campaign["id"] = app.create_mailchimp_campaign("Bench subject", DRAFT_TEXT, segment)
+
+    actions = [
+        ("mirror_sync", mirror.sync, None),
+        ("fetch_segment_record", lambda: app.fetch_segment_record(segment), None),
+        ("update_status", select_one, None),
+        ("reset_segment_status", lambda: app.reset_segment_status(segment), select_one),
+        ("generate_email_draft", lambda: app.generate_email_draft("Bench subject", "Bench description", segment), None),
+        ("create_mailchimp_campaign", push_new, None),
+        ("update_mailchimp_campaign", lambda: app.create_mailchimp_campaign(
+            "Bench subject", DRAFT_TEXT, segment, campaign_id=campaign.get("id")), None),
+        ("send_draft_email_to_shane", lambda: app.send_draft_email_to_shane("Bench subject", DRAFT_TEXT), None),
+        ("send_approval_notification_to_ben", lambda: app.send_approval_notification_to_ben("Bench subject"), None),
+    ]
+    results = {"mirror_full_sync": {"requests": services.stats.get("mirror_full_sync", {}).get("requests", 0)}}
+    results["actions"] = {
+        name: run_action(services, sink, name, action, runs, setup) for name, action, setup in actions
+    }
+    results["config"] = {
+        "runs": runs, "latency_ms": latency * 1000, "error_rate": error_rate,
+        "rate_limit_rate": rate_limit_rate, "smtp_delay_ms": smtp_delay * 1000, "themes_per_segment": themes,
+    }
+    services.shutdown()
+    sink.shutdown()
+    return results
+
+
+def check_against_baseline(results, baseline):
+    failures = []
+    for name, base in baseline["actions"].items():
+        current = results["actions"].get(name)
+        if current is None:
+            failures.append(f"{name}: missing from results")
+            continue
+        if current["requests_per_action"] > base["requests_per_action"] + 1e-9:
+            failures.append(
+                f"{name}: {current['requests_per_action']:.2f} requests per action "
+                f"(baseline {base['requests_per_action']:.2f})"
+            )
+        byte_limit = base["bytes_per_action"] * (1 + BYTES_TOLERANCE)
+        if current["bytes_per_action"] > byte_limit:
+            failures.append(
+                f"{name}: {current['bytes_per_action']:.0f} bytes per action (limit {byte_limit:.0f})"
+            )
+        limit = base["p95_ms"] * (1 + LATENCY_TOLERANCE) + LATENCY_SLACK_MS
+        if current["p95_ms"] > limit:
+            failures.append(f"{name}: p95 {current['p95_ms']:.1f}ms (limit {limit:.1f}ms)")
+    return failures
+
+
+def print_report(results):
+    print(f"{'action':36} {'req/action':>10} {'p50 ms':>8} {'p95 ms':>8} {'bytes':>9} {'smtp conn':>9} {'errors':>6}")
+    for name, r in results["actions"].items():
+        print(
+            f"{name:36} {r['requests_per_action']:10.2f} {r['p50_ms']:8.1f} {r['p95_ms']:8.1f} "
+            f"{r['bytes_per_action']:9.0f} {r['smtp_connections']:9d} {r['errors']:6d}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the app's helpers against local fake services.")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    parser.add_argument("--latency-ms", type=float, default=20, help="added to every fake HTTP response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of HTTP responses that are 500s")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of HTTP responses that are 429s")
+    parser.add_argument("--smtp-delay-ms", type=float, default=5, help="added to every SMTP reply")
+    parser.add_argument("--themes", type=int, default=30, help="pending themes seeded per segment")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="fail if results regress against this file")
+    parser.add_argument("--write-baseline", action="store_true", help="save these results as the new baseline")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline)
+    results = run_benchmark(
+        args.runs, args.latency_ms / 1000, args.error_rate, args.rate_limit_rate,
+        args.smtp_delay_ms / 1000, args.themes,
+    )
+    print_report(results)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.write_baseline:
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {baseline_path}")
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            failures = check_against_baseline(results, json.load(f))
+        for failure in failures:
+            print(f"REGRESSION: {failure}")
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+# --- PLAN AHEAD ---
+# Drafts future months' themes through OpenAI's Batch API: half the price of
+# live calls, results within 24 hours. `submit` writes one chat-completions
+# request per theme (built by the app's build_prompt) into a JSONL job file and
+# uploads it; `status` polls the job; `collect` downloads the results and saves
+# each finished draft into EmailDraft. The job in flight is remembered in
+# .cache/plan-ahead/state.json, so the three steps can run days apart.
+# --mock swaps OpenAI for a local backend that completes after a few polls.
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PLAN_DIR = os.path.join(".cache", "plan-ahead")
+STATE_PATH = os.path.join(PLAN_DIR, "state.json")
+DEFAULT_MONTHS = 3
+POLL_SECONDS = 60
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_WINDOW = "24h"
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class OpenAIBatches:
+    def __init__(self, client):
+        self.client = client
+
+    def upload(self, path):
+        with open(path, "rb") as f:
+            return self.client.files.create(file=f, purpose="batch").id
+
+    def create(self, file_id):
+        return self.client.batches.create(
+            input_file_id=file_id, endpoint=BATCH_ENDPOINT, completion_window=BATCH_WINDOW
+        ).id
+
+    def retrieve(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        return {
+            "status": batch.status,
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id,
+            "completed": counts.completed if counts else 0,
+            "failed": counts.failed if counts else 0,
+            "total": counts.total if counts else 0,
+        }
+
+    def download(self, file_id):
+        return self.client.files.content(file_id).text
+
+
+class MockBatches:
+    # Same interface, backed by a local directory. A job reports validating,
+    # then in_progress, then completed with one canned draft per request.
+    STAGES = ["validating", "in_progress", "completed"]
+
+    def __init__(self, root=os.path.join(PLAN_DIR, "mock")):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def upload(self, path):
+        file_id = f"file-mock-{int(time.time() * 1000)}"
+        with open(path) as src, open(self.path(file_id), "w") as dst:
+            dst.write(src.read())
+        return file_id
+
+    def create(self, file_id):
+        batch_id = f"batch-mock-{int(time.time() * 1000)}"
+        with open(self.path(batch_id), "w") as f:
+            json.dump({"input_file_id": file_id, "polls": 0}, f)
+        return batch_id
+
+    def retrieve(self, batch_id):
+        with open(self.path(batch_id)) as f:
+            batch = json.load(f)
+        batch["polls"] += 1
+        with open(self.path(batch_id), "w") as f:
+            json.dump(batch, f)
+        status = self.STAGES[min(batch["polls"], len(self.STAGES)) - 1]
+        with open(self.path(batch["input_file_id"])) as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        output_file_id = None
+        if status == "completed":
+            output_file_id = f"{batch_id}-output"
+            with open(self.path(output_file_id), "w") as f:
+                for request in requests:
+                    f.write(json.dumps(self.respond(request)) + "\n")
+        done = len(requests) if status == "completed" else 0
+        return {
+            "status": status, "output_file_id": output_file_id, "error_file_id": None,
+            "completed": done, "failed": 0, "total": len(requests),
+        }
+
+    def respond(self, request):
+        theme = request["body"]["messages"][-1]["content"]
+        subject = next((line[len("Subject: "):] for line in theme.splitlines() if line.startswith("Subject: ")), "")
+        draft = (
+            f"Hi *|FNAME|*\n\nA mock draft about {subject or 'this theme'}.\n\n"
+            "Warm regards,\nShane\n\nP.S. My diary is open if you'd like to talk it through."
+        )
+        return {
+            "id": f"mock-{request['custom_id']}",
+            "custom_id": request["custom_id"],
+            "response": {
+                "status_code": 200,
+                "body": {
+                    "choices": [{"message": {"role": "assistant", "content": draft}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0},
+                },
+            },
+            "error": None,
+        }
+
+    def download(self, file_id):
+        with open(self.path(file_id)) as f:
+            return f.read()
+
+
+def future_months(app, count):
+    # The next `count` months after the current one, as Airtable's "October 2026" labels
+    current = datetime.strptime(app.get_month(), "%B %Y")
+    months = []
+    year, month = current.year, current.month
+    for _ in range(count):
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        months.append(datetime(year, month, 1).strftime("%B %Y"))
+    return months
+
+
+def load_future_themes(app, months, statuses):
+    # Undrafted themes for those months, in the configured segments
+    formula = "AND({EmailDraft} = '', OR(" + ", ".join(f"{{Status}} = '{s}'" for s in statuses) + "))"
+    return [
+        record for record in app.iter_airtable_records(formula, fields=app.THEME_FIELDS)
+        if record["fields"].get("Month") in months and record["fields"].get("Segment") in app.SEGMENTS
+    ]
+
+
+def write_job_file(app, themes, path):
+    # One request per theme; the record id doubles as the batch custom_id
+    with open(path, "w") as f:
+        for theme in themes:
+            fields = theme["fields"]
+            f.write(json.dumps({
+                "custom_id": theme["id"],
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": {
+                    "model": app.DRAFT_MODEL,
+                    "messages": app.build_prompt(fields["Subject"], fields["Description"], fields["Segment"]),
+                    "temperature": app.DRAFT_TEMPERATURE,
+                    "prompt_cache_key": app.PROMPT_CACHE_KEY,
+                },
+            }) + "\n")
+
+
+def parse_results(text):
+    # {record_id: draft} for finished drafts, and {record_id: reason} for the rest
+    drafts, failures = {}, {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            failures[result["custom_id"]] = (result.get("error") or {}).get("message") or f"HTTP {response.get('status_code')}"
+            continue
+        choice = response["body"]["choices"][0]
+        # A truncated draft is never saved, same as in the app
+        if choice.get("finish_reason") != "stop":
+            failures[result["custom_id"]] = f"stopped early ({choice.get('finish_reason')})"
+            continue
+        drafts[result["custom_id"]] = choice["message"]["content"].strip()
+    return drafts, failures
+
+
+def still_undrafted(app, record_ids):
+    if not record_ids:
+        return set()
+    ids = ", ".join(f"RECORD_ID() = '{record_id}'" for record_id in record_ids)
+    formula = f"AND({{EmailDraft}} = '', OR({ids}))"
+    return {record["id"] for record in app.iter_airtable_records(formula, fields=["EmailDraft"])}
+
+
+def load_state():
+    if not os.path.exists(STATE_PATH):
+        return None
+    with open(STATE_PATH) as f:
+        return json.load(f)
+
+
+def save_state(state):
+    with open(STATE_PATH, "w") as f:
+        json.dump(state, f, indent=2)
+
+
+def submit(app, backend, months, statuses):
+    themes = load_future_themes(app, months, statuses)
+    if not themes:
+        print(f"No undrafted themes for {', '.join(months)}")
+        return None
+    path = os.path.join(PLAN_DIR, f"job-{int(time.time())}.jsonl")
+    write_job_file(app, themes, path)
+    batch_id = backend.create(backend.upload(path))
+    state = {
+        "batch_id": batch_id,
+        "mock": isinstance(backend, MockBatches),
+        "job_file": path,
+        "submitted": time.time(),
+        "themes": {t["id"]: f"{t['fields']['Month']} · {t['fields']['Segment']}: {t['fields']['Subject']}" for t in themes},
+    }
+    save_state(state)
+    print(f"Submitted {len(themes)} theme(s) for {', '.join(months)} as {batch_id}")
+    return state
+
+
+def collect(app, backend, state, wait):
+    info = backend.retrieve(state["batch_id"])
+    while wait and info["status"] not in TERMINAL_STATUSES:
+        print(f"{state['batch_id']}: {info['status']} ({info['completed']}/{info['total']})")
+        time.sleep(0 if state["mock"] else POLL_SECONDS)
+        info = backend.retrieve(state["batch_id"])
+    print(f"{state['batch_id']}: {info['status']} ({info['completed']}/{info['total']}, {info['failed']} failed)")
+    if info["status"] not in TERMINAL_STATUSES:
+        return None
+    drafts, failures = {}, {}
+    if info["output_file_id"]:
+        drafts, failures = parse_results(backend.download(info["output_file_id"]))
+    if info["error_file_id"]:
+        failures.update(parse_results(backend.download(info["error_file_id"]))[1])
+    # On a retry, drafts saved by the earlier collect are not written again
+    saved_before = set(state.get("saved", []))
+    drafts = {record_id: draft for record_id, draft in drafts.items() if record_id not in saved_before}
+    # Mechanical rule breaks are fixed here; anything else is listed for a manual pass in the app
+    for record_id, draft in drafts.items():
+        drafts[record_id], issues = app.lint_draft(draft)
+        for issue in app.lint_blocking(issues):
+            print(f"  ⚠️ {state['themes'].get(record_id, record_id)}: {issue['message']}")
+    for record_id in state["themes"]:
+        if record_id not in drafts and record_id not in failures and record_id not in saved_before:
+            failures[record_id] = f"no result (job {info['status']})"
+    # A draft written in the app since the job was submitted wins over the batch result
+    open_ids = still_undrafted(app, list(drafts))
+    for record_id in set(drafts) - open_ids:
+        print(f"  - {state['themes'].get(record_id, record_id)} (drafted in the meantime, kept)")
+    saved = app.batch_update_records({record_id: {"EmailDraft": drafts[record_id]} for record_id in open_ids})
+    for record_id, ok in saved.items():
+        print(f"  {'✓' if ok else '✗ not saved'} {state['themes'].get(record_id, record_id)}")
+    for record_id, reason in failures.items():
+        print(f"  ✗ {state['themes'].get(record_id, record_id)} ({reason})")
+    state["saved"] = sorted(saved_before | {record_id for record_id, ok in saved.items() if ok})
+    if all(saved.values()):
+        os.replace(STATE_PATH, os.path.join(PLAN_DIR, f"{state['batch_id']}.done.json"))
+    else:
+        # Paid-for drafts that didn't save stay collectable
+        save_state(state)
+        print("Some drafts were not saved; run collect again to retry them")
+    return {"saved": sum(saved.values()), "failed": len(failures) + list(saved.values()).count(False)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Draft future months' themes with the OpenAI Batch API.")
+    parser.add_argument("command", choices=["submit", "status", "collect"])
+    parser.add_argument("--months", type=int, default=DEFAULT_MONTHS, help="how many months ahead to draft")
+    parser.add_argument("--include-pending", action="store_true", help="also draft themes not yet selected")
+    parser.add_argument("--wait", action="store_true", help="with collect, poll until the job finishes")
+    parser.add_argument("--mock", action="store_true", help="use the local mock backend instead of OpenAI")
+    args = parser.parse_args()
+
+    sys.path.insert(0, APP_DIR)
+    import streamlit_app as app
+
+    # The mock backend needs no OpenAI client
+    app.init_headless(warm_clients=False)
+
+    os.makedirs(PLAN_DIR, exist_ok=True)
+    state = load_state()
+    mock = state["mock"] if state else args.mock
+    backend = MockBatches() if mock else OpenAIBatches(app.get_openai_client())
+
+    if args.command == "submit":
+        if state:
+            parser.error(f"{state['batch_id']} is still outstanding; run collect first")
+        statuses = ["selected", "pending"] if args.include_pending else ["selected"]
+        submit(app, backend, future_months(app, args.months), statuses)
+    elif not state:
+        parser.error("no batch job in flight; run submit first")
+    elif args.command == "status":
+        info = backend.retrieve(state["batch_id"])
+        print(f"{state['batch_id']}: {info['status']} ({info['completed']}/{info['total']}, {info['failed']} failed)")
+    else:
+        result = collect(app, backend, state, args.wait)
+        if result is None:
+            print("Not finished yet; run collect again later")
+        else:
+            print(f"Done: {result['saved']} saved, {result['failed']} failed")
+            sys.exit(1 if result["failed"] else 0)
@@ -0,0 +1,82 @@
+import argparse
+import socketserver
+import threading
+import time
+
+# --- LOCAL SMTP SINK ---
+# A tiny SMTP server that accepts and discards mail, for testing the app's
+# mailer offline. Run it, then set SMTP_HOST = "localhost", SMTP_PORT = 1025
+# and SMTP_STARTTLS = "false" in .streamlit/secrets.toml.
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.wfile.write(f"{line}\r\n".encode("ascii"))
+
+    def handle(self):
+        self.server.record("connections")
+        self.reply("220 localhost SMTP sink")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 localhost")
+            elif command.startswith(("MAIL", "RCPT", "RSET", "NOOP")):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data in iter(self.rfile.readline, b""):
+                    if data in (b".\r\n", b".\n"):
+                        break
+                    size += len(data)
+                self.server.record("messages", size)
+                self.reply("250 OK: queued")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="localhost", port=1025, delay=0.0):
+        super().__init__((host, port), SinkHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.stats = {"connections": 0, "messages": 0, "bytes": 0}
+
+    def record(self, key, size=0):
+        with self.lock:
+            self.stats[key] += 1
+            self.stats["bytes"] += size
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local SMTP sink that discards mail.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1025)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before every reply")
+    args = parser.parse_args()
+
+    with SMTPSink(args.host, args.port, args.delay) as sink:
+        print(f"SMTP sink listening on {args.host}:{sink.port}")
+        try:
+            sink.serve_forever()
+        except KeyboardInterrupt:
+            print(f"\n{sink.stats}")
@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# --- STARTUP BUDGET ---
+# Reports how long a cold process takes to import streamlit_app and to render
+# the first page, and checks that rarely used modules stay unloaded. Each
+# measurement runs in a fresh interpreter. Network calls are stubbed with an
+# empty Airtable table, so only the app's own start-up cost is measured.
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_app.py")
+IMPORT_BUDGET_MS = 1000
+FIRST_RENDER_BUDGET_MS = 1500
+LAZY_MODULES = ["openai", "smtplib", "email.mime.text", "tarfile", "numpy"]
+FAKE_SECRETS = [
+    "AIRTABLE_PAT", "AIRTABLE_BASE_ID", "OPENAI_API_KEY", "SMTP_USERNAME", "SMTP_PASSWORD",
+    "REVIEWER_EMAIL", "NOTIFY_EMAIL", "MAILCHIMP_API_KEY", "MAILCHIMP_SERVER_PREFIX",
+    "MAILCHIMP_AUDIENCE_ID", "MAILCHIMP_TAG_ID_PRE_RETIREES", "MAILCHIMP_TAG_ID_RETIREES",
+]
+
+
+def measure_import():
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    start = time.perf_counter()
+    import streamlit_app  # noqa: F401
+    elapsed = (time.perf_counter() - start) * 1000
+    return {"import_ms": elapsed, "loaded_lazy_modules": [m for m in LAZY_MODULES if m in sys.modules]}
+
+
+def measure_first_render():
+    from unittest import mock
+
+    import requests
+    from streamlit.testing.v1 import AppTest
+
+    def empty_table(self, method, url, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"records": []}'
+        return response
+
+    with mock.patch("requests.Session.request", empty_table):
+        app = AppTest.from_file(APP_PATH, default_timeout=60)
+        for key in FAKE_SECRETS:
+            app.secrets[key] = "0"
+        start = time.perf_counter()
+        app.run()
+        elapsed = (time.perf_counter() - start) * 1000
+    if app.exception:
+        raise RuntimeError(app.exception[0].message)
+    return {"first_render_ms": elapsed, "loaded_lazy_modules": [m for m in LAZY_MODULES if m in sys.modules]}
+
+
+def run_child(kind):
+    # A fresh interpreter in a scratch directory, so caches and the local mirror start cold
+    with tempfile.TemporaryDirectory() as workdir:
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", kind],
+            cwd=workdir, capture_output=True, text=True, check=True,
+        )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report cold import and first-render time for the app.")
+    parser.add_argument("--child", choices=["import", "render"], help=argparse.SUPPRESS)
+    parser.add_argument("--json", help="append the results as one JSON line to this file")
+    args = parser.parse_args()
+
+    if args.child:
+        result = measure_import() if args.child == "import" else measure_first_render()
+        print(json.dumps(result))
+        sys.exit(0)
+
+    imported = run_child("import")
+    rendered = run_child("render")
+    report = {
+        "import_ms": round(imported["import_ms"], 1),
+        "first_render_ms": round(rendered["first_render_ms"], 1),
+        "loaded_lazy_modules": imported["loaded_lazy_modules"],
+    }
+    failures = []
+    if report["import_ms"] > IMPORT_BUDGET_MS:
+        failures.append(f"import took {report['import_ms']:.0f}ms (budget {IMPORT_BUDGET_MS}ms)")
+    if report["first_render_ms"] > FIRST_RENDER_BUDGET_MS:
+        failures.append(f"first render took {report['first_render_ms']:.0f}ms (budget {FIRST_RENDER_BUDGET_MS}ms)")
+    if report["loaded_lazy_modules"]:
+        failures.append(f"imported eagerly: {', '.join(report['loaded_lazy_modules'])}")
+
+    print(f"import:       {report['import_ms']:8.1f} ms  (budget {IMPORT_BUDGET_MS} ms)")
+    print(f"first render: {report['first_render_ms']:8.1f} ms  (budget {FIRST_RENDER_BUDGET_MS} ms)")
+    print(f"lazy modules loaded at import: {', '.join(report['loaded_lazy_modules']) or 'none'}")
+    if args.json:
+        with open(args.json, "a") as f:
+            f.write(json.dumps(dict(report, timestamp=time.time(), ok=not failures)) + "\n")
+    for failure in failures:
+        print(f"OVER BUDGET: {failure}")
+    sys.exit(1 if failures else 0)
@@ -1,27 +1,134 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import requests
-from datetime import datetime
-import pytz
-from openai import OpenAI
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 import json
+from string import Template
+import hashlib
+import os
+import sqlite3
+import itertools
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+from contextlib import contextmanager
+from collections import deque
+from requests.adapters import HTTPAdapter
 
 # --- SECRETS ---
-AIRTABLE_PAT = st.secrets["AIRTABLE_PAT"]
-AIRTABLE_BASE_ID = st.secrets["AIRTABLE_BASE_ID"]
+# Secrets and clients are resolved on first use, not at import. Heavy or rarely
+# used modules (openai, smtplib, email.mime, tarfile) are imported inside the
+# functions that need them, so a rerun only pays for what it touches.
+AIRTABLE_API_URL = "https://api.airtable.com/v0"
 AIRTABLE_TABLE_NAME = "MonthlyThemes"
-client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+SEGMENTS = ["Pre-Retiree", "Retiree"]
 
-HEADERS = {
-    "Authorization": f"Bearer {AIRTABLE_PAT}",
-    "Content-Type": "application/json"
-}
+def airtable_url(record_id=None):
+    url = f"{AIRTABLE_API_URL}/{st.secrets['AIRTABLE_BASE_ID']}/{AIRTABLE_TABLE_NAME}"
+    return f"{url}/{record_id}" if record_id else url
+
+def airtable_headers():
+    return {
+        "Authorization": f"Bearer {st.secrets['AIRTABLE_PAT']}",
+        "Content-Type": "application/json"
+    }
+
+@st.cache_resource
+def get_openai_client():
+    from openai import OpenAI
+    return OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
+
+# --- HTTP CLIENT ---
+# Shared by the Airtable and Mailchimp helpers: keep-alive pooling, per-host
+# throttling, retries with backoff on 429/5xx and explicit timeouts.
+HTTP_TIMEOUT = (3.05, 30)  # (connect, read) seconds
+HTTP_MAX_RETRIES = 4
+HTTP_BACKOFF_SECONDS = 0.5
+HTTP_MAX_BACKOFF_SECONDS = 30
+HOST_RATE_LIMITS = {"api.airtable.com": 5}  # requests per second
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Reserve a token under the lock, then sleep outside it if we went into debt
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class HttpClient(requests.Session):
+    def __init__(self, rate_limits=None, timeout=HTTP_TIMEOUT, max_retries=HTTP_MAX_RETRIES,
+                 backoff=HTTP_BACKOFF_SECONDS, pool_size=10):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.buckets = {host: TokenBucket(rate) for host, rate in (rate_limits or {}).items()}
+
+    def backoff_delay(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), HTTP_MAX_BACKOFF_SECONDS)
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(HTTP_MAX_BACKOFF_SECONDS, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        if current_trace_group() is None:
+            return self.send_with_retries(method, url, **kwargs)
+        with trace_call(*trace_target(method, url)) as event:
+            response = self.send_with_retries(method, url, **kwargs)
+            event["status"] = response.status_code
+            event["bytes"] = len(response.request.body or b"") + len(response.content)
+            return response
+
+    def send_with_retries(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        bucket = self.buckets.get(urlsplit(url).hostname)
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            if bucket:
+                bucket.acquire()
+            try:
+                response = super().request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                # A non-idempotent request may already have been applied upstream
+                if last_attempt or not idempotent:
+                    raise
+                time.sleep(self.backoff_delay(attempt))
+                continue
+            # 429 means the request was rejected, so it is always safe to resend
+            retryable = response.status_code == 429 or (response.status_code >= 500 and idempotent)
+            if not retryable or last_attempt:
+                return response
+            time.sleep(self.backoff_delay(attempt, response))
+
+@st.cache_resource
+def get_http_client():
+    return HttpClient(rate_limits=HOST_RATE_LIMITS)
 
 # --- SHARED PROMPT BUILDER ---
-def build_prompt(subject, description, segment, extra=None):
-    personas = {
+# The instruction block is static and sent first as the system message, so
+# every draft request shares a long cacheable prefix. Per-theme variables and
+# any extra instructions follow as the user message.
+PERSONAS = {
     "Pre-Retiree": (
         "These readers are in their 50s or early 60s and still working—often juggling business, work, or family commitments.\n"
         "They’ve done well financially but want to ensure they’re not missing anything as retirement comes into view.\n\n"
@@ -47,14 +154,12 @@ def build_prompt(subject, description, segment, extra=None):
         "- Early-stage questions like 'Can we scale back work?'\n"
         "- Business exits, accumulation strategies, or contribution rules"
     )
-    }
-    base_prompt = f"""
-Your job is to help a time-poor, financially successful Australian {segment.lower()} reader see something important they’ve been putting off or unsure about—without sounding alarmist or promotional.
+}
 
-Use the subject and theme description below as your starting point. They must shape the core insight and message of the email. Do not reinterpret or reframe them.
-Subject: {subject}
-Theme description: {description}
-Persona: {personas[segment]}
+STATIC_PROMPT = """
+Your job is to help a time-poor, financially successful Australian reader see something important they’ve been putting off or unsure about—without sounding alarmist or promotional.
+
+The reader segment, persona, subject and theme description are given in the next message. Use the subject and theme description as your starting point. They must shape the core insight and message of the email. Do not reinterpret or reframe them.
 
 You are writing on behalf of Shane Hatch from Hatch Financial Planning in Logan, Queensland.
 The audience includes individuals or couples with at least $1 million in investable assets (excluding their home), aged approximately 50–70.
@@ -154,60 +259,741 @@ Paragraphs.
 Each sentence or two must appear on its own line. Insert two hard line breaks (press Return twice) after every one or two sentences. Do not group sentences into paragraphs under any circumstances.
 En dashes (–) or em dashes (—). Use standard hyphens (-) only and only when necessary.
 """
-    
+
+def build_prompt(subject, description, segment, extra=None):
+    theme_prompt = f"""Reader segment: {segment}
+Persona: {PERSONAS[segment]}
+
+Subject: {subject}
+Theme description: {description}"""
+
     if extra:
-        base_prompt += f"\n\nAdditional instructions: {extra}"
-    return base_prompt
+        theme_prompt += f"\n\nAdditional instructions: {extra}"
+    return [
+        {"role": "system", "content": STATIC_PROMPT},
+        {"role": "user", "content": theme_prompt},
+    ]
+
+
+# --- DRAFT FORMATS ---
+# label: (button key prefix, instruction appended to the extra prompt)
+DRAFT_FORMATS = {
+    "Direct Insight": ("insight", "\nFormat: direct insight"),
+    "Story": ("story", "\nFormat: story"),
+    "Exercise": ("exercise", "\nFormat: exercise"),
+    "Recent Study": ("study", """\nReference a recent study.
+Do not fabricate data or statistics. Only include references to studies or findings that are plausible and widely reported.
+Avoid citing exact figures (e.g. “63%”) unless you are confident they are accurate and well-established.
+Prefer general phrasing such as “A recent study found…” or “Surveys often show…” Do not mention the reader’s demographic, age, or personal situation—keep the reference broad and relevant to the theme. If you can’t confidently cite a known study, imply a trend without stating specific details."""),
+    "Myth Buster": ("myth", "\nFormat: myth buster"),
+    "Case Study": ("case", "\nFormat: case study"),
+    "Q&A": ("qa", "\nFormat: Q&A"),
+}
+
+# --- DRAFT LINTER ---
+# Checks a draft against the hard rules in STATIC_PROMPT. Mechanical breaks
+# (greeting, dashes, spelling, formatting, line breaks) are fixed in place;
+# the rest are reported. Only unfixed "error" issues are worth a regeneration.
+LINT_MAX_REGENERATIONS = 1
+GREETING = "Hi *|FNAME|*"
+IZE_STEMS = [
+    "real", "optim", "organ", "priorit", "recogn", "minim", "maxim", "util", "special", "summar",
+    "emphas", "apolog", "final", "stabil", "categor", "personal", "modern", "author", "visual",
+    "capital", "central", "standard", "rational", "synchron", "monet", "critic", "memor",
+]
+OUR_WORDS = ["color", "favor", "behavior", "honor", "labor", "neighbor", "endeavor", "humor"]
+AU_SPELLINGS = {
+    **{
+        stem + us: stem + au
+        for stem in IZE_STEMS
+        for us, au in [("ize", "ise"), ("izes", "ises"), ("ized", "ised"), ("izing", "ising"),
+                       ("ization", "isation"), ("izations", "isations")]
+    },
+    **{
+        word + suffix: word[:-2] + "our" + suffix
+        for word in OUR_WORDS
+        for suffix in ["", "s", "ed", "ing"]
+    },
+    "analyze": "analyse", "analyzed": "analysed", "analyzing": "analysing",
+    "favorite": "favourite", "favorites": "favourites", "favorable": "favourable",
+    "center": "centre", "centers": "centres", "centered": "centred",
+    "fulfill": "fulfil", "fulfillment": "fulfilment", "enrollment": "enrolment",
+    "traveling": "travelling", "traveled": "travelled", "canceled": "cancelled", "canceling": "cancelling",
+    "modeling": "modelling", "catalog": "catalogue", "defense": "defence", "aging": "ageing",
+}
+# Americanisms whose Australian word changes the meaning in some uses ("calendar
+# year"), so they are reported rather than replaced
+WORD_CHOICES = {"calendar": "diary", "vacation": "holiday"}
+GPT_ISMS = [
+    "clarity is key", "say yes to what you want", "it's not just about the numbers",
+    "you deserve peace of mind", "gain clarity", "plan your future", "secure your retirement",
+    "unlock your potential", "imagine the freedom", "imagine knowing", "imagine this", "it can feel like",
+    "make the most of your money", "you've worked hard", "delve", "navigate the complexities",
+    "in today's fast-paced world", "it's important to note", "embark on", "game-changer", "tapestry",
+]
+SOFT_QUALIFIERS = ["might", "maybe", "perhaps", "could be", "can help"]
+
+SUBJECT_LINE_PATTERN = re.compile(r"\A(?:email )?subject(?: line)?\s*:[^\n]*\s*", re.IGNORECASE)
+# Only the salutation, with an optional name and its punctuation; the rest of the line is body text
+GREETING_PATTERN = re.compile(
+    r"\A(?i:hi|hello|hey|dear|g'day)\b"
+    r"(?:[ \t]+(?:\*\|FNAME\|\*|(?i:there|all|everyone|friends?)|[A-Z][a-z]+)(?=[ \t]*(?:[,!:\n]|-\s|\Z)))?"
+    r"[ \t]*(?:,|[-!:](?=\s))?[ \t]*"
+)
+DASH_PATTERN = re.compile(r"(?P<range>(?<=\d)\s*[–—]\s*(?=\d))|\s*[–—]\s*")
+MARKDOWN_PATTERN = re.compile(r"\*\*(.+?)\*\*|__(.+?)__")
+BULLET_PATTERN = re.compile(r"^[ \t]*(?:[-•*]|\d+[.)])[ \t]+", re.MULTILINE)
+# Words are looked up in AU_SPELLINGS (every key has five letters or more);
+# one big alternation of the keys is several times slower
+WORD_PATTERN = re.compile(r"\b[A-Za-z]{5,}\b")
+SENTENCE_BREAK = re.compile(r"(?:(?<=[.!?])|(?<=[.!?][”\"’]))\s+(?=[“\"‘]?[A-Z])")
+ABBREVIATION_END = re.compile(r"\b(?:e\.g|i\.e|etc|Mr|Mrs|Ms|Dr|vs)\.$")
+SIGN_OFF_PATTERN = re.compile(
+    r"^(?:warm(?:est)? regards|kind regards|best regards|best wishes|warm wishes|regards|warmly|all the best|cheers)\b",
+    re.IGNORECASE | re.MULTILINE,
+)
+PS_PATTERN = re.compile(r"^P\.?\s?S\b", re.IGNORECASE | re.MULTILINE)
+GPT_ISM_PATTERN = re.compile(
+    r"\b(" + "|".join(re.escape(p).replace("'", "['’]") for p in GPT_ISMS) + r")\b", re.IGNORECASE
+)
+WORD_CHOICE_PATTERN = re.compile(r"\b(" + "|".join(WORD_CHOICES) + r")s?\b", re.IGNORECASE)
+SOFT_QUALIFIER_PATTERN = re.compile(r"\b(" + "|".join(SOFT_QUALIFIERS) + r")\b", re.IGNORECASE)
+
+def _match_case(original, replacement):
+    if original.isupper():
+        return replacement.upper()
+    if original[0].isupper():
+        return replacement[0].upper() + replacement[1:]
+    return replacement
+
+def _starts_sentence(text, position):
+    before = text[:position].rstrip(" \t\"“‘'(")
+    return not before or before[-1] in ".!?\n"
+
+def _split_sentences(text):
+    sentences = []
+    for part in SENTENCE_BREAK.split(text):
+        if sentences and ABBREVIATION_END.search(sentences[-1]):
+            sentences[-1] += " " + part
+        else:
+            sentences.append(part)
+    return sentences
+
+def _fix_blocks(text):
+    # One or two sentences per block, blocks separated by a blank line. The
+    # sign-off block ("Warm regards,\nShane") keeps its single line break.
+    blocks = []
+    for block in re.split(r"\n\s*\n", text):
+        if SIGN_OFF_PATTERN.match(block):
+            blocks.append(block)
+            continue
+        for line in filter(None, (line.strip() for line in block.split("\n"))):
+            sentences = _split_sentences(line)
+            blocks.extend(" ".join(sentences[i:i + 2]) for i in range(0, len(sentences), 2))
+    return "\n\n".join(blocks)
+
+def _issue(rule, message, fixed, severity="error", excerpt=None):
+    return {"rule": rule, "message": message, "fixed": fixed, "severity": severity, "excerpt": excerpt}
+
+def lint_draft(text):
+    # Returns (fixed_text, issues)
+    issues = []
+    text = text.replace("\r\n", "\n").strip()
+
+    def fix(rule, message, pattern, replacement):
+        nonlocal text
+        found = [m.group(0).strip() for m in pattern.finditer(text)]
+        if found:
+            text = pattern.sub(replacement, text)
+            issues.append(_issue(rule, message, True, excerpt=", ".join(dict.fromkeys(found))))
+
+    # A "Subject: ..." line above the greeting belongs in Mailchimp, not the body
+    fix("subject_line", "Subject line removed from the body", SUBJECT_LINE_PATTERN, "")
+    fix("formatting", "Bold or underline formatting removed", MARKDOWN_PATTERN, lambda m: m.group(1) or m.group(2))
+    fix("formatting", "Bullet points removed", BULLET_PATTERN, "")
+    fix("dashes", "En/em dashes replaced with hyphens", DASH_PATTERN, lambda m: "-" if m.group("range") else " - ")
+    american, names = set(), set()
+
+    def au_spelling(m):
+        word = m.group(0)
+        replacement = AU_SPELLINGS.get(word.lower())
+        if replacement is None:
+            return word
+        # Capitalised mid-sentence is most likely a name ("Pew Research Center"); leave it
+        if word[0].isupper() and not _starts_sentence(m.string, m.start()):
+            names.add(word)
+            return word
+        american.add(word)
+        return _match_case(word, replacement)
+
+    text = WORD_PATTERN.sub(au_spelling, text)
+    if american:
+        issues.append(_issue("spelling", "American spelling changed to Australian", True, excerpt=", ".join(sorted(american))))
+    if names:
+        issues.append(_issue("spelling", "American spelling in what looks like a name, left as is", False,
+                             "warning", ", ".join(sorted(names))))
+
+    if not text.startswith(GREETING):
+        greeting = GREETING_PATTERN.match(text)
+        opener = greeting.group(0).strip() if greeting else None
+        rest = text[greeting.end():].lstrip() if greeting else text
+        if greeting and rest:
+            # Body text that shared the greeting's line now opens its own block
+            rest = rest[0].upper() + rest[1:]
+        text = GREETING + ("," if opener and opener.endswith(",") else "") + "\n\n" + rest
+        issues.append(_issue("greeting", f'Opening changed to "{GREETING}"', True, excerpt=opener))
+
+    blocked = _fix_blocks(text)
+    if blocked != text:
+        text = blocked
+        issues.append(_issue("line_breaks", "Split into blocks of one or two sentences", True))
+
+    ps = PS_PATTERN.search(text)
+    sign_off = SIGN_OFF_PATTERN.search(text)
+    if not ps:
+        issues.append(_issue("ps", "No P.S. linking to Shane's diary", False))
+    if not sign_off or (ps and sign_off.start() > ps.start()):
+        issues.append(_issue("sign_off", "No sign-off before the P.S.", False))
+    phrases = [m.group(0) for m in GPT_ISM_PATTERN.finditer(text)]
+    if phrases:
+        issues.append(_issue("gpt_isms", "Banned stock phrases", False, excerpt=", ".join(dict.fromkeys(phrases))))
+    choices = [m.group(1).lower() for m in WORD_CHOICE_PATTERN.finditer(text)]
+    if choices:
+        suggestions = ", ".join(f"{word} → {WORD_CHOICES[word]}" for word in dict.fromkeys(choices))
+        issues.append(_issue("word_choice", "American word choice", False, "warning", suggestions))
+    qualifiers = [m.group(0).lower() for m in SOFT_QUALIFIER_PATTERN.finditer(text)]
+    if qualifiers:
+        issues.append(_issue("qualifiers", "Soft qualifiers", False, "warning", ", ".join(dict.fromkeys(qualifiers))))
+    return text, issues
+
+def lint_blocking(issues):
+    return [i for i in issues if not i["fixed"] and i["severity"] == "error"]
 
 
 # --- HELPERS ---
 def get_month():
-    brisbane = pytz.timezone("Australia/Brisbane")
+    brisbane = ZoneInfo("Australia/Brisbane")
     now = datetime.now(brisbane)
     return now.strftime("%B %Y")
 
-def fetch_segment_record(segment):
-    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
-    params = {
-        "filterByFormula": f"AND(Segment = '{segment}', Month = '{get_month()}')",
-        "pageSize": 10
+def in_script_run():
+    # False on background threads (the outbox worker, the mirror sync) and in scripts
+    return get_script_run_ctx(suppress_warning=True) is not None
+
+def count_http_call():
+    if not in_script_run():
+        return
+    st.session_state["http_calls"] = st.session_state.get("http_calls", 0) + 1
+
+# --- TRACING ---
+# Off unless the Diagnostics toggle is on. Every outbound call (Airtable,
+# Mailchimp, OpenAI, SMTP) is then timed and recorded against the current rerun
+# and the button that triggered it, shown in the sidebar and appended to a
+# rotating JSONL file. When off, a call site only does one session_state lookup.
+TRACE_PATH = os.path.join(".cache", "trace.jsonl")
+TRACE_MAX_BYTES = 5_000_000
+TRACE_BACKUPS = 3
+TRACE_HISTORY = 20
+TRACE_ID_PATTERN = re.compile(r"^(rec[A-Za-z0-9]{14}|[0-9a-f]{10})$")
+_trace_local = threading.local()
+
+class TraceFile:
+    def __init__(self, path=TRACE_PATH, max_bytes=TRACE_MAX_BYTES, backups=TRACE_BACKUPS):
+        from logging.handlers import RotatingFileHandler
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # The handler does the locking and the size-based rotation
+        self.handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+        self.path = path
+        self.background = False
+
+    def write(self, event):
+        import logging
+        self.handler.handle(logging.makeLogRecord({"msg": json.dumps(event, default=str)}))
+
+@st.cache_resource
+def get_trace_file():
+    return TraceFile()
+
+def current_trace_group():
+    if in_script_run():
+        return st.session_state.get("trace_rerun")
+    return getattr(_trace_local, "group", None)
+
+def start_trace_rerun():
+    # Called at the top of every rerun; the previous rerun moves into the history
+    if not st.session_state.get("diagnostics"):
+        st.session_state.pop("trace_rerun", None)
+        return
+    previous = st.session_state.get("trace_rerun")
+    history = st.session_state.setdefault("trace_history", [])
+    if previous and previous["calls"]:
+        history.append(previous)
+        del history[:-TRACE_HISTORY]
+    number = st.session_state["trace_reruns"] = st.session_state.get("trace_reruns", 0) + 1
+    st.session_state["trace_rerun"] = {
+        "session": get_script_run_ctx().session_id[:8],
+        "rerun": number,
+        "action": None,
+        "started": time.time(),
+        "calls": [],
     }
-    response = requests.get(url, headers=HEADERS, params=params)
-    if response.status_code != 200:
-        st.error(f"Error fetching records for {segment}: {response.text}")
+
+def name_trace_action(action):
+    group = st.session_state.get("trace_rerun")
+    if group is not None:
+        group["action"] = action
+
+def action_button(label, key=None, **kwargs):
+    # st.button that names the current rerun's trace after the click it handles
+    clicked = st.button(label, key=key, **kwargs)
+    if clicked:
+        name_trace_action(f"{label} [{key}]" if key else label)
+    return clicked
+
+@contextmanager
+def traced_job(action):
+    # Groups a background thread's calls under one action while background tracing is on
+    if not get_trace_file().background:
+        yield
+        return
+    _trace_local.group = {"session": None, "rerun": None, "action": action, "started": time.time(), "calls": []}
+    try:
+        yield
+    finally:
+        _trace_local.group = None
+
+def trace_target(method, url):
+    parts = urlsplit(url)
+    service = next((s for s in ["airtable", "mailchimp", "openai"] if s in url.lower()), parts.hostname)
+    path = "/".join(":id" if TRACE_ID_PATTERN.match(p) else p for p in parts.path.split("/"))
+    return service, f"{method.upper()} {path}"
+
+@contextmanager
+def trace_call(service, endpoint):
+    # Yields None when tracing is off, otherwise an event the caller can add status, bytes and tokens to
+    group = current_trace_group()
+    if group is None:
+        yield None
+        return
+    event = {"service": service, "endpoint": endpoint, "status": None, "bytes": 0}
+    start = time.perf_counter()
+    try:
+        yield event
+    except Exception as e:
+        event["status"] = event["status"] or type(e).__name__
+        raise
+    finally:
+        event["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        event.update(ts=time.time(), session=group["session"], rerun=group["rerun"], action=group["action"])
+        group["calls"].append(event)
+        get_trace_file().write(event)
+
+# --- LOCAL MIRROR ---
+# MonthlyThemes is mirrored into SQLite and every read is served from it. A
+# background thread pulls only records modified since the last sync (with a
+# full resync now and then to drop deleted records); writes go to Airtable and
+# the returned records are written straight into the mirror.
+MIRROR_PATH = os.path.join(".cache", "themes.sqlite3")
+MIRROR_SYNC_SECONDS = 15
+MIRROR_FULL_SYNC_SECONDS = 3600
+MIRROR_OVERLAP_SECONDS = 60  # re-read a margin so clock skew never drops an edit
+MIRROR_READY_TIMEOUT = 30
+
+def month_key(month):
+    try:
+        return datetime.strptime(month, "%B %Y").strftime("%Y-%m")
+    except (TypeError, ValueError):
+        return ""
+
+def iter_airtable_records(formula=None, fields=None, sort=None, page_size=100):
+    # Follows Airtable's offset cursor lazily, one page per request.
+    # fields limits the payload to those columns; sort is [(field, "asc"|"desc"), ...].
+    url = airtable_url()
+    params = {"pageSize": page_size}
+    if formula:
+        params["filterByFormula"] = formula
+    if fields:
+        params["fields[]"] = list(fields)
+    for i, (field, direction) in enumerate(sort or []):
+        params[f"sort[{i}][field]"] = field
+        params[f"sort[{i}][direction]"] = direction
+    while True:
+        count_http_call()
+        response = get_http_client().get(url, headers=airtable_headers(), params=params)
+        if response.status_code != 200:
+            raise requests.HTTPError(response.text, response=response)
+        data = response.json()
+        yield from data.get("records", [])
+        if not data.get("offset"):
+            return
+        params["offset"] = data["offset"]
+
+def iter_pages(records, size=100):
+    page = []
+    for record in records:
+        page.append(record)
+        if len(page) == size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+class ThemeMirror:
+    def __init__(self, path=MIRROR_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()  # one sync at a time: a full sync's deletes rely on it
+        self.wake = threading.Event()
+        self.ready = threading.Event()
+        self.last_error = None
+        self.written = set()  # ids upserted since the running sync started
+        self.version = 0  # bumped on every change, so readers can skip unchanged snapshots
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "id TEXT PRIMARY KEY, month TEXT, month_key TEXT, segment TEXT, status TEXT, "
+                "created_time TEXT, fields TEXT NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS records_month ON records (month, segment)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        if self.meta("last_sync"):
+            self.ready.set()
+
+    def meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _upsert(self, records):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO records (id, month, month_key, segment, status, created_time, fields) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    r["id"],
+                    r["fields"].get("Month"),
+                    month_key(r["fields"].get("Month")),
+                    r["fields"].get("Segment"),
+                    r["fields"].get("Status"),
+                    r.get("createdTime"),
+                    json.dumps(r["fields"]),
+                )
+                for r in records
+            ],
+        )
+
+    def upsert(self, records):
+        with self.lock, self.conn:
+            self._upsert(records)
+            self.written.update(r["id"] for r in records)
+            self.version += 1
+
+    def sync(self, full=False):
+        with self.sync_lock:
+            return self._sync(full)
+
+    def _sync(self, full):
+        started = datetime.now(timezone.utc)
+        last_sync = self.meta("last_sync")
+        last_full = self.meta("last_full_sync")
+        full = full or not last_sync or not last_full or (
+            started - datetime.fromisoformat(last_full)
+        ).total_seconds() > MIRROR_FULL_SYNC_SECONDS
+        if full:
+            records = iter_airtable_records()
+        else:
+            since = datetime.fromisoformat(last_sync).timestamp() - MIRROR_OVERLAP_SECONDS
+            since = datetime.fromtimestamp(since, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            records = iter_airtable_records(f"IS_AFTER(LAST_MODIFIED_TIME(), '{since}')")
+        # Pages are written as they arrive, so readers never see a half-empty mirror.
+        # Anything upserted while the sync runs (including local writes) is kept.
+        with self.lock:
+            self.written = set()
+        seen = set()
+        for page in iter_pages(records):
+            self.upsert(page)
+            seen.update(r["id"] for r in page)
+        with self.lock, self.conn:
+            if full:
+                stale = [
+                    (row[0],) for row in self.conn.execute("SELECT id FROM records").fetchall()
+                    if row[0] not in seen and row[0] not in self.written
+                ]
+                self.conn.executemany("DELETE FROM records WHERE id = ?", stale)
+                self.version += bool(stale)
+            updates = [("last_sync", started.isoformat())]
+            if full:
+                updates.append(("last_full_sync", started.isoformat()))
+            self.conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", updates)
+        self.last_error = None
+        self.ready.set()
+        return len(seen)
+
+    def _rows(self, query, args):
+        with self.lock:
+            rows = self.conn.execute(query, args).fetchall()
+        return [{"id": row[0], "createdTime": row[1], "fields": json.loads(row[2])} for row in rows]
+
+    def snapshot(self):
+        # The version is read first, so a change made meanwhile is picked up next time
+        version = self.version
+        return version, self._rows("SELECT id, created_time, fields FROM records", ())
+
+    def records_for_month(self, month):
+        return self._rows(
+            "SELECT id, created_time, fields FROM records WHERE month = ? ORDER BY created_time, id", (month,)
+        )
+
+    def history(self, segment, status="selected", limit=24):
+        return self._rows(
+            "SELECT id, created_time, fields FROM records WHERE segment = ? AND status = ? "
+            "ORDER BY month_key DESC LIMIT ?",
+            (segment, status, limit),
+        )
+
+    def run_forever(self):
+        while True:
+            try:
+                with traced_job("mirror sync"):
+                    self.sync()
+            except Exception as e:
+                # Anything unexpected is reported too; the thread must outlive one bad sync
+                self.last_error = str(e) if isinstance(e, (requests.RequestException, sqlite3.Error)) else repr(e)
+            self.wake.wait(MIRROR_SYNC_SECONDS)
+            self.wake.clear()
+
+    def start(self):
+        threading.Thread(target=self.run_forever, name="mirror-sync", daemon=True).start()
+        return self
+
+@st.cache_resource
+def get_mirror():
+    return ThemeMirror().start()
+
+def fetch_month_snapshot(month):
+    mirror = get_mirror()
+    # Only the very first sync of a fresh mirror is waited on, and not past a failure
+    deadline = time.monotonic() + MIRROR_READY_TIMEOUT
+    while not mirror.ready.wait(0.1):
+        if mirror.last_error or time.monotonic() > deadline:
+            raise requests.ConnectionError(mirror.last_error or "Timed out waiting for the first Airtable sync")
+    return mirror.records_for_month(month)
+
+def fetch_segment_record(segment):
+    # A failed first sync is reported once per run; later reads in the same run don't wait again
+    if in_script_run() and st.session_state.get("mirror_error"):
+        return []
+    try:
+        records = fetch_month_snapshot(get_month())
+    except requests.RequestException as e:
+        if in_script_run():
+            st.session_state["mirror_error"] = str(e)
+        st.error(f"Error fetching records from Airtable: {e}")
         return []
-    return response.json().get("records", [])
+    return [r for r in records if r["fields"].get("Segment") == segment]
+
+# --- SIMILARITY INDEX ---
+# Flags themes and drafts that repeat one already used for the segment in
+# another month, before a draft is paid for. Every mirrored record gives two
+# documents: its theme (Subject + Description) and its EmailDraft. Term counts
+# and document frequencies are updated only for records whose text changed
+# since the mirror's last version; the TF-IDF rows are then rebuilt as flat
+# NumPy arrays and a batch of texts is scored against them in one pass.
+SIMILARITY_THRESHOLDS = {"theme": 0.5, "draft": 0.6}  # cosine similarity
+SIMILARITY_MIN_TERM_LENGTH = 3
+SIMILARITY_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset("""
+    about above after again against all and any are because been before being below between both but
+    can could did does doing down during each few for from further had has have having her here hers
+    him his how into its just more most not now off once only other our ours out over own same she
+    should some such than that the their theirs them then there these they this those through too
+    under until very was were what when where which while who whom why will with would you your yours
+""".split())
+
+def similarity_terms(text):
+    return [
+        term for term in SIMILARITY_TOKEN_PATTERN.findall(text.lower())
+        if len(term) >= SIMILARITY_MIN_TERM_LENGTH and term not in STOP_WORDS
+    ]
 
-def update_status(segment, new_record_id):
-    current_month = get_month()
-    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
-    params = {
-        "filterByFormula": f"AND(Segment = '{segment}', Status = 'selected', Month = '{current_month}')"
+def similarity_documents(record):
+    fields = record["fields"]
+    return {
+        "theme": f"{fields.get('Subject') or ''}\n{fields.get('Description') or ''}".strip(),
+        "draft": (fields.get("EmailDraft") or "").strip(),
     }
-    response = requests.get(url, headers=HEADERS, params=params)
-    if response.status_code == 200:
-        for record in response.json().get("records", []):
-            record_id = record["id"]
-            if record_id != new_record_id:
-                requests.patch(
-                    f"{url}/{record_id}",
-                    headers=HEADERS,
-                    json={"fields": {"Status": "pending"}}
-                )
 
-    # Now mark the new record as selected
-    patch_url = f"{url}/{new_record_id}"
-    payload = {"fields": {"Status": "selected"}}
-    res = requests.patch(patch_url, json=payload, headers=HEADERS)
-    return res.status_code == 200
+class SimilarityIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.vocab = {}  # term -> column
+        self.df = []  # documents containing each column's term
+        self.docs = {}  # (record_id, kind) -> {"text", "terms": {column: count}, "record"}
+        self.matrix = None
+
+    def _add(self, key, text, record):
+        terms = {}
+        for term in similarity_terms(text):
+            column = self.vocab.setdefault(term, len(self.vocab))
+            if column == len(self.df):
+                self.df.append(0)
+            terms[column] = terms.get(column, 0) + 1
+        for column in terms:
+            self.df[column] += 1
+        self.docs[key] = {"text": text, "terms": terms, "record": record}
+
+    def _remove(self, key):
+        for column in self.docs.pop(key)["terms"]:
+            self.df[column] -= 1
+
+    def refresh(self, mirror):
+        with self.lock:
+            if mirror.version == self.version:
+                return
+            version, records = mirror.snapshot()
+            seen = set()
+            for record in records:
+                for kind, text in similarity_documents(record).items():
+                    key = (record["id"], kind)
+                    seen.add(key)
+                    doc = self.docs.get(key)
+                    if doc and doc["text"] == text:
+                        doc["record"] = record  # status or month changed, the text didn't
+                        continue
+                    if doc:
+                        self._remove(key)
+                    if text:
+                        self._add(key, text, record)
+            for key in set(self.docs) - seen:
+                self._remove(key)
+            self.version = version
+            self.matrix = None
+
+    def _build(self):
+        import numpy as np
+        keys = [key for key, doc in self.docs.items() if doc["terms"]]
+        lengths = np.array([len(self.docs[key]["terms"]) for key in keys], dtype=np.int64)
+        columns = np.fromiter(
+            itertools.chain.from_iterable(self.docs[key]["terms"] for key in keys), dtype=np.int64, count=lengths.sum()
+        )
+        counts = np.fromiter(
+            itertools.chain.from_iterable(self.docs[key]["terms"].values() for key in keys),
+            dtype=np.float64, count=lengths.sum(),
+        )
+        idf = np.log((1 + len(self.docs)) / (1 + np.array(self.df, dtype=np.float64))) + 1
+        data = (1 + np.log(counts)) * idf[columns]
+        if keys:
+            starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            data /= np.repeat(np.sqrt(np.add.reduceat(data ** 2, starts)), lengths)
+        records = [self.docs[key]["record"] for key in keys]
+        self.matrix = {
+            "records": records,
+            "columns": columns,
+            "data": data,
+            "lengths": lengths,
+            "idf": idf,
+            "unseen_idf": np.log(1 + len(self.docs)) + 1,
+            "kind": np.array([key[1] for key in keys]),
+            "segment": np.array([r["fields"].get("Segment") or "" for r in records]),
+            "status": np.array([r["fields"].get("Status") or "" for r in records]),
+            "month": np.array([r["fields"].get("Month") or "" for r in records]),
+        }
+
+    def nearest(self, texts, kind, segment, month):
+        # Closest selected record of the segment from another month, per text:
+        # (record, score) when the score reaches the kind's threshold, else None
+        import numpy as np
+        with self.lock:
+            if self.matrix is None:
+                self._build()
+            m = self.matrix
+            history = (m["kind"] == kind) & (m["segment"] == segment) & (m["status"] == "selected") & (m["month"] != month)
+            if not texts or not history.any():
+                return [None] * len(texts)
+            queries = np.zeros((len(texts), len(m["idf"])))
+            unseen = np.zeros(len(texts))
+            for i, text in enumerate(texts):
+                counts = {}
+                for term in similarity_terms(text):
+                    counts[term] = counts.get(term, 0) + 1
+                for term, count in counts.items():
+                    column = self.vocab.get(term)
+                    if column is None:
+                        unseen[i] += ((1 + np.log(count)) * m["unseen_idf"]) ** 2
+                    else:
+                        queries[i, column] = (1 + np.log(count)) * m["idf"][column]
+            norms = np.sqrt((queries ** 2).sum(axis=1) + unseen)
+            # Only the history rows are multiplied: their slices of the flat arrays
+            rows = np.flatnonzero(history)
+            entries = np.repeat(history, m["lengths"])
+            lengths = m["lengths"][rows]
+            starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            scores = np.add.reduceat(queries[:, m["columns"][entries]] * m["data"][entries], starts, axis=1)
+            scores /= np.maximum(norms, 1e-12)[:, None]
+            best = scores.argmax(axis=1)
+            return [
+                (m["records"][rows[j]], float(scores[i, j])) if scores[i, j] >= SIMILARITY_THRESHOLDS[kind] else None
+                for i, j in enumerate(best)
+            ]
+
+@st.cache_resource
+def get_similarity_index():
+    return SimilarityIndex()
+
+def find_repeats(segment, texts, kind):
+    index = get_similarity_index()
+    index.refresh(get_mirror())
+    return index.nearest(texts, kind, segment, get_month())
+
+def repeat_note(match):
+    record, score = match
+    return f"{score:.0%} similar to {record['fields'].get('Month')}'s “{record['fields'].get('Subject')}”"
+
+# --- BATCHED WRITES ---
+# Airtable's bulk endpoint takes up to 10 records per PATCH.
+AIRTABLE_BATCH_SIZE = 10
+
+def batch_update_records(updates):
+    # updates: {record_id: fields}. Returns {record_id: True/False}.
+    url = airtable_url()
+    items = list(updates.items())
+    results = {}
+    for i in range(0, len(items), AIRTABLE_BATCH_SIZE):
+        chunk = items[i:i + AIRTABLE_BATCH_SIZE]
+        payload = {"records": [{"id": record_id, "fields": fields} for record_id, fields in chunk]}
+        count_http_call()
+        updated = set()
+        try:
+            res = get_http_client().patch(url, json=payload, headers=airtable_headers())
+        except requests.RequestException:
+            res = None
+        if res is not None and res.status_code == 200:
+            records = res.json().get("records", [])
+            get_mirror().upsert(records)
+            updated = {r["id"] for r in records}
+        for record_id, _ in chunk:
+            results[record_id] = record_id in updated
+    return results
+
+def plan_status_changes(segment, record_id=None, status="selected"):
+    # Everything currently selected/skipped goes back to pending, record_id gets status
+    changes = {}
+    for record in fetch_segment_record(segment):
+        if record["id"] != record_id and record["fields"].get("Status") in ["selected", "skipped"]:
+            changes[record["id"]] = {"Status": "pending"}
+    if record_id:
+        changes[record_id] = {"Status": status}
+    return changes
+
+def update_status(segment, new_record_id, status="selected"):
+    results = batch_update_records(plan_status_changes(segment, new_record_id, status))
+    return all(results.values())
 
 def reset_segment_status(segment):
-    records = fetch_segment_record(segment)
-    for record in records:
-        if record["fields"].get("Status") in ["selected", "skipped"]:
-            record_id = record["id"]
-            url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}/{record_id}"
-            requests.patch(url, json={"fields": {"Status": "pending"}}, headers=HEADERS)
+    results = batch_update_records(plan_status_changes(segment))
+    return all(results.values())
 
 def fetch_pending_themes(segment):
     return [r for r in fetch_segment_record(segment) if r["fields"].get("Status") == "pending"]
@@ -220,33 +1006,595 @@ def fetch_skipped(segment):
     records = fetch_segment_record(segment)
     return next((r for r in records if r["fields"].get("Status") == "skipped"), None)
 
+DRAFT_MODEL = "gpt-4o"
+DRAFT_TEMPERATURE = 0.7
+
+# --- TOKEN ACCOUNTING ---
+# Keep requests that share STATIC_PROMPT on the same provider cache shard
+PROMPT_CACHE_KEY = "monthly-theme-draft"
+
+def usage_counts(usage):
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "cached_tokens": (getattr(details, "cached_tokens", None) or 0) if details else 0,
+        "completion_tokens": usage.completion_tokens,
+    }
+
+def record_token_usage(segment, usage):
+    if usage is None:
+        return None
+    counts = dict(usage_counts(usage), segment=segment)
+    if in_script_run():
+        st.session_state.setdefault("token_usage", []).append(counts)
+    return counts
+
+def token_usage_summary():
+    entries = st.session_state.get("token_usage", [])
+    return {
+        key: sum(e[key] for e in entries)
+        for key in ["prompt_tokens", "cached_tokens", "completion_tokens"]
+    } | {"calls": len(entries)}
+
+def trace_completion(event, messages, text, finish_reason, usage):
+    # Bytes are the prompt and completion text, not the wire size
+    if event is None:
+        return
+    event["status"] = finish_reason
+    event["bytes"] = len(json.dumps(messages).encode("utf-8")) + len((text or "").encode("utf-8"))
+    if usage is not None:
+        event["tokens"] = usage_counts(usage)
+
+# --- GENERATION ENGINE ---
+# Every draft request gets a deadline, retries with backoff on 429s, 5xx and
+# timeouts, and a fallback model once the primary's retries are spent. When
+# a request is slower than the recent p95 (time to first token for streams),
+# a second, hedged request is sent and whichever answers first is kept.
+# Every attempt is logged with its latency for the diagnostics panel.
+DRAFT_FALLBACK_MODEL = "gpt-4o-mini"
+DRAFT_DEADLINE_SECONDS = 120
+DRAFT_MAX_RETRIES = 2
+DRAFT_BACKOFF_SECONDS = 1.0
+DRAFT_HEDGE_PERCENTILE = 0.95
+DRAFT_HEDGE_MIN_SAMPLES = 20
+# Hedge thresholds until enough latencies have been seen, in seconds
+DRAFT_HEDGE_DEFAULTS = {"complete": 45, "stream": 10}
+
+class DraftDeadlineExceeded(TimeoutError):
+    pass
+
+class DraftEngine:
+    def __init__(self, client, model=DRAFT_MODEL, fallback_model=DRAFT_FALLBACK_MODEL,
+                 deadline=DRAFT_DEADLINE_SECONDS, max_retries=DRAFT_MAX_RETRIES,
+                 hedge_percentile=DRAFT_HEDGE_PERCENTILE):
+        from concurrent.futures import ThreadPoolExecutor
+        # Retries are ours, so the SDK's own are switched off
+        self.client = client.with_options(max_retries=0)
+        self.models = [model] + ([fallback_model] if fallback_model and fallback_model != model else [])
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.hedge_percentile = hedge_percentile
+        self.pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="draft-engine")
+        self.lock = threading.Lock()
+        self.latencies = {"complete": deque(maxlen=200), "stream": deque(maxlen=200)}
+        self.attempts = deque(maxlen=200)
+
+    def hedge_after(self, kind):
+        if not self.hedge_percentile:
+            return None
+        with self.lock:
+            samples = sorted(self.latencies[kind])
+        if len(samples) < DRAFT_HEDGE_MIN_SAMPLES:
+            return DRAFT_HEDGE_DEFAULTS[kind]
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile))]
+
+    def backoff_delay(self, attempt, error):
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return DRAFT_BACKOFF_SECONDS * 2 ** attempt * (1 + random.random())
+
+    def _attempt(self, kind, model, role, request, timeout, log):
+        start = time.monotonic()
+        outcome = "cancelled"
+        try:
+            result = request(model, max(timeout, 0.1))
+            outcome = "ok"
+            return result
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            entry = {"kind": kind, "model": model, "role": role, "latency": time.monotonic() - start,
+                     "outcome": outcome, "at": time.time()}
+            with self.lock:
+                self.attempts.append(entry)
+                if outcome == "ok":
+                    self.latencies[kind].append(entry["latency"])
+            log.append(entry)
+
+    def _race(self, kind, model, request, deadline, discard, log):
+        from concurrent.futures import FIRST_COMPLETED, wait
+        futures = [self.pool.submit(self._attempt, kind, model, "primary", request, deadline - time.monotonic(), log)]
+        hedge_after = self.hedge_after(kind)
+        if hedge_after is not None and hedge_after < deadline - time.monotonic():
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                futures.append(self.pool.submit(
+                    self._attempt, kind, model, "hedge", request, deadline - time.monotonic(), log
+                ))
+        pending, error = set(futures), None
+        while pending:
+            done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                for future in pending:
+                    future.add_done_callback(discard)
+                raise DraftDeadlineExceeded(f"No response from {model} within {self.deadline}s")
+            for future in done:
+                if future.exception() is None:
+                    # The slower request runs on; its result is thrown away when it lands
+                    for other in pending:
+                        other.add_done_callback(discard)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def run(self, kind, request, discard=lambda future: None):
+        # Returns (result, {"model": ..., "attempts": [...]})
+        import openai
+        deadline = time.monotonic() + self.deadline
+        log, error = [], None
+        for model in self.models:
+            for attempt in range(self.max_retries + 1):
+                if time.monotonic() >= deadline:
+                    break
+                try:
+                    result = self._race(kind, model, request, deadline, discard, log)
+                    return result, {"model": model, "attempts": list(log)}
+                except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError,
+                        DraftDeadlineExceeded) as e:
+                    error = e
+                    if attempt < self.max_retries:
+                        time.sleep(min(self.backoff_delay(attempt, e), max(0, deadline - time.monotonic())))
+                except openai.NotFoundError as e:
+                    # The model itself is unavailable; go straight to the fallback
+                    error = e
+                    break
+        raise error or DraftDeadlineExceeded(f"No response within {self.deadline}s")
+
+    def complete(self, messages, **kwargs):
+        def request(model, timeout):
+            return self.client.chat.completions.create(model=model, messages=messages, timeout=timeout, **kwargs)
+        return self.run("complete", request)
+
+    def stream(self, messages, **kwargs):
+        # The race is to the first token; the winner's stream is then read to the end
+        def request(model, timeout):
+            stream = self.client.chat.completions.create(
+                model=model, messages=messages, timeout=timeout, stream=True, **kwargs
+            )
+            chunks, head = iter(stream), []
+            for chunk in chunks:
+                head.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+            return stream, head, chunks
+
+        def discard(future):
+            if not future.cancelled() and future.exception() is None:
+                future.result()[0].close()
+
+        (_, head, chunks), meta = self.run("stream", request, discard)
+        return itertools.chain(head, chunks), meta
+
+    def summary(self):
+        with self.lock:
+            attempts = list(self.attempts)
+            latencies = {kind: sorted(values) for kind, values in self.latencies.items()}
+        percentiles = {
+            kind: (values[len(values) // 2], values[min(len(values) - 1, int(len(values) * 0.95))])
+            for kind, values in latencies.items() if values
+        }
+        return {"attempts": attempts, "percentiles": percentiles}
+
+@st.cache_resource
+def get_draft_engine():
+    return DraftEngine(
+        get_openai_client(),
+        fallback_model=st.secrets.get("OPENAI_FALLBACK_MODEL", DRAFT_FALLBACK_MODEL),
+        deadline=float(st.secrets.get("OPENAI_DEADLINE_SECONDS", DRAFT_DEADLINE_SECONDS)),
+        hedge_percentile=float(st.secrets.get("OPENAI_HEDGE_PERCENTILE", DRAFT_HEDGE_PERCENTILE)),
+    )
+
+def request_email_draft(messages, segment):
+    with trace_call("openai", "chat.completions") as event:
+        response, meta = get_draft_engine().complete(
+            messages,
+            temperature=DRAFT_TEMPERATURE,
+            prompt_cache_key=PROMPT_CACHE_KEY,
+        )
+        choice = response.choices[0]
+        trace_completion(event, messages, choice.message.content, choice.finish_reason, response.usage)
+        if event is not None:
+            event.update(model=meta["model"], attempts=len(meta["attempts"]))
+    record_token_usage(segment, response.usage)
+    return choice.message.content.strip()
+
 def generate_email_draft(subject, description, segment):
-    prompt = build_prompt(subject, description, segment)
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.7,
+    # Linted and fixed; asks again only while unfixable rules fail, keeping the best attempt
+    messages = build_prompt(subject, description, segment)
+    best = None
+    for _ in range(LINT_MAX_REGENERATIONS + 1):
+        draft, issues = lint_draft(request_email_draft(messages, segment))
+        blocking = lint_blocking(issues)
+        if best is None or len(blocking) < len(best[1]):
+            best = (draft, blocking)
+        if not blocking:
+            break
+    return best[0]
+
+# --- STREAMED GENERATION ---
+def stream_draft(messages, stats):
+    # Yields tokens as they arrive and fills stats with timings, usage and completion state
+    start = time.monotonic()
+    engine = get_draft_engine()
+    with trace_call("openai", "chat.completions (stream)") as event:
+        stream, meta = engine.stream(
+            messages,
+            temperature=DRAFT_TEMPERATURE,
+            stream_options={"include_usage": True},
+            prompt_cache_key=PROMPT_CACHE_KEY,
+        )
+        stats.update(model=meta["model"], attempts=meta["attempts"])
+        parts = []
+        for chunk in stream:
+            if time.monotonic() - start > engine.deadline:
+                # Past the deadline the draft is abandoned rather than left to trickle in
+                stats["finish_reason"] = "deadline"
+                break
+            if getattr(chunk, "usage", None):
+                stats["usage"] = chunk.usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta.content:
+                stats.setdefault("ttft", time.monotonic() - start)
+                if event is not None:
+                    parts.append(choice.delta.content)
+                yield choice.delta.content
+            if choice.finish_reason:
+                stats["finish_reason"] = choice.finish_reason
+        trace_completion(event, messages, "".join(parts), stats.get("finish_reason"), stats.get("usage"))
+        if event is not None:
+            event.update(model=meta["model"], attempts=len(meta["attempts"]))
+    stats["total"] = time.monotonic() - start
+
+def write_draft_stream(messages, segment):
+    # Returns (draft, model that answered); draft is None when nothing usable came back
+    import openai
+    stats = {}
+    try:
+        text = st.write_stream(stream_draft(messages, stats))
+    except (openai.OpenAIError, TimeoutError) as e:
+        # Retries and the fallback model are already spent by now
+        stats["error"] = str(e)
+    complete = stats.get("finish_reason") == "stop"
+    st.session_state.setdefault("generation_log", []).append({
+        "segment": segment,
+        "ttft": stats.get("ttft"),
+        "total": stats.get("total"),
+        "complete": complete,
+        "usage": record_token_usage(segment, stats.get("usage")),
+        "model": stats.get("model"),
+        "attempts": stats.get("attempts", []),
+    })
+    if "error" in stats:
+        st.error(f"Draft generation failed ({stats['error']}). The previous draft was kept.")
+        return None, stats.get("model")
+    if not complete:
+        # Never let a truncated draft overwrite the previous one
+        st.error(f"Draft generation stopped early ({stats.get('finish_reason', 'no finish reason')}). The previous draft was kept.")
+        return None, stats.get("model")
+    return text.strip(), stats.get("model")
+
+def write_checked_draft(messages, segment):
+    # Streams a draft and lints it; streams once more while unfixable rules fail.
+    # Returns (draft, model that answered it).
+    best = None
+    for attempt in range(LINT_MAX_REGENERATIONS + 1):
+        text, model = write_draft_stream(messages, segment)
+        if text is None:
+            break
+        draft, issues = lint_draft(text)
+        blocking = lint_blocking(issues)
+        if best is None or len(blocking) < len(best[1]):
+            best = (draft, blocking, model)
+        if not blocking:
+            break
+        if attempt < LINT_MAX_REGENERATIONS:
+            st.info("Regenerating, the draft broke rules that can't be fixed automatically: "
+                    + "; ".join(i["message"] for i in blocking))
+    return (best[0], best[2]) if best else (None, None)
+
+def render_lint_report(draft, segment, record_id):
+    # Flags rule breaks in the current draft; mechanical ones can be fixed in one click
+    fixed, issues = lint_draft(draft)
+    for issue in issues:
+        if issue["fixed"]:
+            continue
+        excerpt = f": {issue['excerpt']}" if issue["excerpt"] else ""
+        (st.warning if issue["severity"] == "error" else st.caption)(f"⚠️ {issue['message']}{excerpt}")
+    fixable = [i["message"] for i in issues if i["fixed"]]
+    if fixable and action_button(f"🧹 Apply automatic fixes for {segment}", key=f"lint_fix_{segment}",
+                                 help="; ".join(fixable)):
+        if update_airtable_fields(record_id, {"EmailDraft": fixed}):
+            rerun_segment()
+
+def last_generation(segment):
+    log = [g for g in st.session_state.get("generation_log", []) if g["segment"] == segment]
+    return log[-1] if log else None
+
+# --- LOCAL DRAFT CACHE ---
+# Opt-in, content-addressed by the fully built prompt, model and temperature.
+# Keeps a few drafts per key and evicts least-recently-used drafts past a size cap.
+DRAFT_CACHE_PATH = os.path.join(".cache", "drafts.sqlite3")
+DRAFT_CACHE_PER_KEY = 5
+DRAFT_CACHE_MAX_BYTES = 5_000_000
+
+def draft_cache_key(messages, model, temperature):
+    payload = json.dumps({"messages": messages, "model": model, "temperature": temperature}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class DraftCache:
+    def __init__(self, path=DRAFT_CACHE_PATH, per_key=DRAFT_CACHE_PER_KEY, max_bytes=DRAFT_CACHE_MAX_BYTES):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.per_key = per_key
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS drafts ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, draft TEXT NOT NULL, "
+            "size INTEGER NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS drafts_key ON drafts (key)")
+        self.conn.commit()
+
+    def get(self, key):
+        # Newest first; reading a key counts as a use for LRU eviction
+        with self.lock, self.conn:
+            rows = self.conn.execute(
+                "SELECT draft FROM drafts WHERE key = ? ORDER BY created DESC", (key,)
+            ).fetchall()
+            self.conn.execute("UPDATE drafts SET last_used = ? WHERE key = ?", (time.time(), key))
+        return [row[0] for row in rows]
+
+    def put(self, key, draft):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO drafts (key, draft, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, draft, len(draft.encode("utf-8")), now, now),
+            )
+            self.conn.execute(
+                "DELETE FROM drafts WHERE key = ? AND id NOT IN "
+                "(SELECT id FROM drafts WHERE key = ? ORDER BY created DESC LIMIT ?)",
+                (key, key, self.per_key),
+            )
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM drafts").fetchone()[0]
+            for row_id, size in self.conn.execute(
+                "SELECT id, size FROM drafts ORDER BY last_used, created"
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM drafts WHERE id = ?", (row_id,))
+                total -= size
+
+@st.cache_resource
+def get_draft_cache():
+    return DraftCache()
+
+def generate_draft(messages, segment):
+    # Serves the newest cached draft when the cache is on, unless a fresh sample is forced
+    if not st.session_state.get("use_draft_cache"):
+        return write_checked_draft(messages, segment)[0]
+    cache = get_draft_cache()
+    if not st.session_state.get(f"force_fresh_{segment}"):
+        cached = cache.get(draft_cache_key(messages, DRAFT_MODEL, DRAFT_TEMPERATURE))
+        if cached:
+            return cached[0]
+    draft, model = write_checked_draft(messages, segment)
+    if draft:
+        # Filed under the model that answered, so a fallback draft never passes as the primary's
+        cache.put(draft_cache_key(messages, model or DRAFT_MODEL, DRAFT_TEMPERATURE), draft)
+    return draft
+
+def render_cached_drafts(messages, segment, record_id):
+    cached = get_draft_cache().get(draft_cache_key(messages, DRAFT_MODEL, DRAFT_TEMPERATURE))
+    if not cached:
+        return
+    st.markdown(f"**📚 {len(cached)} cached draft(s) for this prompt**")
+    index = 0
+    if len(cached) > 1:
+        index = st.number_input(
+            "Cached draft", min_value=1, max_value=len(cached), value=1, key=f"cached_page_{segment}"
+        ) - 1
+    st.text_area(
+        "Cached draft preview",
+        value=cached[index],
+        height=200,
+        disabled=True,
+        label_visibility="collapsed",
+        # Keyed by content: a fresh draft moves into this slot without a rerender otherwise
+        key=f"cached_preview_{segment}_{hashlib.sha256(cached[index].encode()).hexdigest()[:12]}",
+    )
+    if action_button("Use this cached draft", key=f"use_cached_{segment}"):
+        if update_airtable_fields(record_id, {"EmailDraft": cached[index]}):
+            rerun_segment()
+
+# --- CONCURRENT VARIANTS ---
+VARIANT_CONCURRENCY = 4
+
+async def _create_variant(async_client, messages, models):
+    # The SDK retries 429s and 5xx with backoff; the next model is tried once those run out
+    import openai
+    for i, model in enumerate(models):
+        try:
+            return await async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=DRAFT_TEMPERATURE,
+                prompt_cache_key=PROMPT_CACHE_KEY,
+            )
+        except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError, openai.NotFoundError):
+            if i == len(models) - 1:
+                raise
+
+async def _generate_variant(async_client, semaphore, job, models):
+    import openai
+    async with semaphore:
+        start = time.monotonic()
+        try:
+            with trace_call("openai", "chat.completions (variant)") as event:
+                response = await _create_variant(async_client, job["messages"], models)
+                choice = response.choices[0]
+                trace_completion(event, job["messages"], choice.message.content, choice.finish_reason, response.usage)
+            # Variants are for comparison, so rule breaks are fixed and flagged but never retried
+            job["draft"], issues = lint_draft(choice.message.content)
+            job["issues"] = [i for i in issues if not i["fixed"]]
+            job["usage"] = usage_counts(response.usage) if response.usage else None
+        except openai.OpenAIError as e:
+            job["error"] = str(e)
+        job["elapsed"] = time.monotonic() - start
+    return job
+
+async def _generate_variants(jobs, concurrency):
+    import asyncio
+    from openai import AsyncOpenAI
+    engine = get_draft_engine()
+    async_client = AsyncOpenAI(
+        api_key=st.secrets["OPENAI_API_KEY"], max_retries=engine.max_retries, timeout=engine.deadline
     )
-    return response.choices[0].message.content.strip()
+    semaphore = asyncio.Semaphore(concurrency)
+    try:
+        return await asyncio.gather(*(_generate_variant(async_client, semaphore, job, engine.models) for job in jobs))
+    finally:
+        await async_client.close()
+
+def generate_variants(themes, formats, concurrency=VARIANT_CONCURRENCY):
+    # themes: {segment: selected record}. One job per (segment, format), run concurrently.
+    jobs = []
+    for segment, record in themes.items():
+        extra = st.session_state.get(f"extra_prompt_{segment}", "")
+        for label in formats:
+            jobs.append({
+                "segment": segment,
+                "record_id": record["id"],
+                "format": label,
+                "messages": build_prompt(
+                    record["fields"]["Subject"],
+                    record["fields"]["Description"],
+                    segment,
+                    extra + DRAFT_FORMATS[label][1],
+                ),
+            })
+    import asyncio
+    start = time.monotonic()
+    results = asyncio.run(_generate_variants(jobs, concurrency))
+    for job in results:
+        if job.get("usage"):
+            st.session_state.setdefault("token_usage", []).append(dict(job["usage"], segment=job["segment"]))
+    return results, time.monotonic() - start
+
+def render_variants_panel(segments):
+    themes = {}
+    for segment in segments:
+        record = fetch_selected_theme(segment)
+        if record and not record["fields"].get("DraftApproved"):
+            themes[segment] = record
+    if not themes:
+        return
+
+    with st.expander("🧪 Generate variants side by side"):
+        formats = st.multiselect("Formats", list(DRAFT_FORMATS), key="variant_formats")
+        chosen = st.multiselect("Segments", list(themes), default=list(themes), key="variant_segments")
+        if action_button("⚡ Generate variants", disabled=not formats or not chosen):
+            with st.spinner(f"Generating {len(formats) * len(chosen)} variants..."):
+                results, elapsed = generate_variants({s: themes[s] for s in chosen}, formats)
+            st.session_state["variants"] = results
+            st.session_state["variants_elapsed"] = elapsed
+
+        results = st.session_state.get("variants", [])
+        if results:
+            slowest = max(r["elapsed"] for r in results)
+            st.caption(
+                f"{len(results)} variants in {st.session_state['variants_elapsed']:.1f}s "
+                f"(slowest single call {slowest:.1f}s)"
+            )
+        for segment in themes:
+            segment_results = [r for r in results if r["segment"] == segment]
+            if not segment_results:
+                continue
+            st.markdown(f"### {segment}")
+            for i, column in enumerate(st.columns(len(segment_results))):
+                variant = segment_results[i]
+                with column:
+                    st.markdown(f"**{variant['format']}**")
+                    if variant.get("error"):
+                        st.error(variant["error"])
+                        continue
+                    sync_editor(f"variant_{segment}_{i}", variant["draft"])
+                    st.text_area(
+                        "Draft",
+                        height=300,
+                        disabled=True,
+                        label_visibility="collapsed",
+                        key=f"variant_{segment}_{i}",
+                    )
+                    for issue in variant.get("issues", []):
+                        st.caption(f"⚠️ {issue['message']}")
+                    if action_button("Use this draft", key=f"use_variant_{segment}_{i}"):
+                        if update_airtable_fields(variant["record_id"], {"EmailDraft": variant["draft"]}):
+                            st.session_state["variants"] = [r for r in results if r["segment"] != segment]
+                            st.rerun()
 
 def update_airtable_fields(record_id, fields):
-    url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}/{record_id}"
-    return requests.patch(url, json={"fields": fields}, headers=HEADERS)
+    # Returns True once Airtable has the change; any failure is reported on the page
+    url = airtable_url(record_id)
+    count_http_call()
+    try:
+        res = get_http_client().patch(url, json={"fields": fields}, headers=airtable_headers())
+    except requests.RequestException as e:
+        # Retries are spent; report it instead of failing the whole page
+        st.error(f"Could not save to Airtable ({e}). Please try again.")
+        return False
+    if res.status_code != 200:
+        st.error("Could not save to Airtable: " + res.text)
+        return False
+    get_mirror().upsert([res.json()])
+    return True
 
-def send_draft_email_to_shane(subject, draft):
-    msg = MIMEMultipart("alternative")
-    msg["Subject"] = f"Draft ready for review: {subject}"
-    msg["From"] = st.secrets["SMTP_USERNAME"]
-    msg["To"] = st.secrets["REVIEWER_EMAIL"]
+# --- MAILER ---
+# One authenticated SMTP connection is kept open and reused for back-to-back
+# sends, dropped after it has been idle and re-opened if the server hangs up.
+# Point SMTP_HOST/SMTP_PORT at a local sink (see smtp_sink.py) to test offline.
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 587
+SMTP_TIMEOUT = 30
+SMTP_IDLE_SECONDS = 60
 
-    html_body = f"""
+REVIEW_EMAIL_TEMPLATE = Template("""
     <html>
     <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
         <p>Hi Shane,</p>
-        <p>Here's the draft email for the "<strong>{subject}</strong>" campaign:</p>
+        <p>Here's the draft email for the "<strong>$subject</strong>" campaign:</p>
         
         <div style="border-left: 4px solid #4CAF50; background-color: #f9f9f9; padding: 16px; margin: 12px 0; font-size: 15px;">
-            {draft.replace('\n', '<br>')}
+            $draft_html
         </div>
         
         <p>
@@ -258,26 +1606,13 @@ def send_draft_email_to_shane(subject, draft):
         <p>– Your automated writing assistant</p>
     </body>
     </html>
-    """
+    """)
 
-    msg.attach(MIMEText(html_body, "html"))
-
-    with smtplib.SMTP("smtp.gmail.com", 587) as server:
-        server.starttls()
-        server.login(st.secrets["SMTP_USERNAME"], st.secrets["SMTP_PASSWORD"])
-        server.sendmail(msg["From"], [msg["To"]], msg.as_string())
-
-def send_approval_notification_to_ben(subject):
-    msg = MIMEMultipart("alternative")
-    msg["Subject"] = f"✅ Approved: {subject}"
-    msg["From"] = st.secrets["SMTP_USERNAME"]
-    msg["To"] = st.secrets["NOTIFY_EMAIL"]
-
-    html_body = f"""
+APPROVAL_EMAIL_TEMPLATE = Template("""
     <html>
     <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
         <p>Hi Ben,</p>
-        <p>The draft email for <strong>{subject}</strong> has been approved by Shane.</p>
+        <p>The draft email for <strong>$subject</strong> has been approved by Shane.</p>
         <p>
             You can review the final copy or continue with the next step here:<br>
             <a href="https://hfp-monthly-theme-selector.streamlit.app/" style="color: #1a73e8;">Open the Streamlit App</a>
@@ -285,73 +1620,555 @@ def send_approval_notification_to_ben(subject):
         <p>– Your automated writing assistant</p>
     </body>
     </html>
-    """
+    """)
+
+def build_message(template, subject_line, sender, recipient, **values):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    msg = MIMEMultipart("alternative")
+    msg["Subject"] = subject_line
+    msg["From"] = sender
+    msg["To"] = recipient
+    msg.attach(MIMEText(template.substitute(values), "html"))
+    return msg
+
+class Mailer:
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, username=None, password=None,
+                 starttls=True, idle_seconds=SMTP_IDLE_SECONDS, timeout=SMTP_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.idle_seconds = idle_seconds
+        self.timeout = timeout
+        self.server = None
+        self.last_used = 0
+        self.lock = threading.Lock()
 
-    msg.attach(MIMEText(html_body, "html"))
+    def connect(self):
+        import smtplib
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            server.starttls()
+        # Local debugging sinks usually don't take credentials
+        if self.password:
+            server.login(self.username, self.password)
+        return server
 
-    with smtplib.SMTP("smtp.gmail.com", 587) as server:
-        server.starttls()
-        server.login(st.secrets["SMTP_USERNAME"], st.secrets["SMTP_PASSWORD"])
-        server.sendmail(msg["From"], [msg["To"]], msg.as_string())
+    def close(self):
+        import smtplib
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+        self.server = None
+
+    def send(self, msg):
+        import smtplib
+        with self.lock:
+            if self.server is not None and time.monotonic() - self.last_used > self.idle_seconds:
+                self.close()
+            with trace_call("smtp", "sendmail") as event:
+                payload = msg.as_string()
+                for attempt in range(2):
+                    if self.server is None:
+                        self.server = self.connect()
+                    try:
+                        self.server.sendmail(msg["From"], [msg["To"]], payload)
+                        break
+                    except smtplib.SMTPServerDisconnected:
+                        # The server closed a connection we thought was alive; reconnect once
+                        self.server = None
+                        if attempt:
+                            raise
+                if event is not None:
+                    event.update(status="sent", bytes=len(payload.encode("utf-8")), attempts=attempt + 1)
+            self.last_used = time.monotonic()
+
+@st.cache_resource
+def get_mailer():
+    return Mailer(
+        host=st.secrets.get("SMTP_HOST", SMTP_HOST),
+        port=int(st.secrets.get("SMTP_PORT", SMTP_PORT)),
+        username=st.secrets["SMTP_USERNAME"],
+        password=st.secrets.get("SMTP_PASSWORD"),
+        starttls=str(st.secrets.get("SMTP_STARTTLS", "true")).lower() == "true",
+    )
+
+def send_draft_email_to_shane(subject, draft):
+    msg = build_message(
+        REVIEW_EMAIL_TEMPLATE,
+        f"Draft ready for review: {subject}",
+        st.secrets["SMTP_USERNAME"],
+        st.secrets["REVIEWER_EMAIL"],
+        subject=subject,
+        draft_html=draft.replace(chr(10), "<br>"),
+    )
+    get_mailer().send(msg)
+
+def send_approval_notification_to_ben(subject):
+    msg = build_message(
+        APPROVAL_EMAIL_TEMPLATE,
+        f"✅ Approved: {subject}",
+        st.secrets["SMTP_USERNAME"],
+        st.secrets["NOTIFY_EMAIL"],
+        subject=subject,
+    )
+    get_mailer().send(msg)
 
 # --- MAILCHIMP LINK ---
+# Each Airtable record remembers its campaign in MAILCHIMP_CAMPAIGN_FIELD, so
+# re-pushing updates that campaign in place instead of creating a duplicate.
+MAILCHIMP_API_URL = "https://{server_prefix}.api.mailchimp.com/3.0"
+MAILCHIMP_CAMPAIGN_FIELD = "MailchimpCampaignId"
+MAILCHIMP_BATCH_POLL_SECONDS = 5
 
-def create_mailchimp_campaign(subject, draft, segment, preview_text=None):
-    api_key = st.secrets["MAILCHIMP_API_KEY"]
-    server_prefix = st.secrets["MAILCHIMP_SERVER_PREFIX"]
-    audience_id = st.secrets["MAILCHIMP_AUDIENCE_ID"]
+def mailchimp_api():
+    base_url = MAILCHIMP_API_URL.format(server_prefix=st.secrets["MAILCHIMP_SERVER_PREFIX"])
+    return base_url, ("anystring", st.secrets["MAILCHIMP_API_KEY"])
 
+def campaign_settings(subject, segment, preview_text=None):
+    settings = {
+        "subject_line": subject,
+        "title": f"{segment} Campaign - {subject}",
+        "from_name": "Hatch Financial Planning",
+        "reply_to": st.secrets["SMTP_USERNAME"],
+        "auto_footer": False
+    }
+    if preview_text:
+        settings["preview_text"] = preview_text
+    return settings
+
+def campaign_data(subject, segment, preview_text=None):
     tag_id = (
         st.secrets["MAILCHIMP_TAG_ID_PRE_RETIREES"]
         if segment == "Pre-Retiree"
         else st.secrets["MAILCHIMP_TAG_ID_RETIREES"]
     )
-
-    base_url = f"https://{server_prefix}.api.mailchimp.com/3.0"
-    auth = ("anystring", api_key)
-
-    campaign_data = {
+    return {
         "type": "regular",
         "recipients": {
-            "list_id": audience_id,
+            "list_id": st.secrets["MAILCHIMP_AUDIENCE_ID"],
             "segment_opts": {
                 "saved_segment_id": int(tag_id)
             }
         },
-        "settings": {
-            "subject_line": subject,
-            "title": f"{segment} Campaign - {subject}",
-            "from_name": "Hatch Financial Planning",
-            "reply_to": st.secrets["SMTP_USERNAME"],
-            "auto_footer": False
-        }
+        "settings": campaign_settings(subject, segment, preview_text)
     }
 
-    campaign_res = requests.post(f"{base_url}/campaigns", auth=auth, json=campaign_data)
-    if campaign_res.status_code != 200:
-        st.error("❌ Failed to create campaign.")
-        st.error(campaign_res.text)
-        return None
-    campaign_id = campaign_res.json()["id"]
-
-    content = {
+def campaign_content(draft):
+    return {
         "plain_text": draft,
         "html": f"<html><body><p>{draft.replace(chr(10), '<br>')}</p></body></html>"
     }
 
-    content_res = requests.put(f"{base_url}/campaigns/{campaign_id}/content", auth=auth, json=content)
-    if content_res.status_code == 200:
-        st.success(f"✅ Campaign created (not sent), ID: {campaign_id}")
+def create_mailchimp_campaign(subject, draft, segment, preview_text=None, progress=None, campaign_id=None):
+    base_url, auth = mailchimp_api()
+    http = get_http_client()
+    # progress survives between outbox attempts, so a retry never creates a second campaign
+    progress = progress if progress is not None else {}
+    campaign_id = progress.get("campaign_id") or campaign_id
+    if campaign_id:
+        res = http.patch(
+            f"{base_url}/campaigns/{campaign_id}", auth=auth,
+            json={"settings": campaign_settings(subject, segment, preview_text)}
+        )
+        if res.status_code != 200:
+            raise requests.HTTPError(f"Failed to update campaign: {res.text}", response=res)
     else:
-        st.error("❌ Failed to set campaign content.")
-        st.error(content_res.text)
+        campaign_res = http.post(f"{base_url}/campaigns", auth=auth, json=campaign_data(subject, segment, preview_text))
+        if campaign_res.status_code != 200:
+            raise requests.HTTPError(f"Failed to create campaign: {campaign_res.text}", response=campaign_res)
+        campaign_id = campaign_res.json()["id"]
+    progress["campaign_id"] = campaign_id
 
-# --- STREAMLIT APP ---
-st.set_page_config(page_title="Monthly Theme Selector", layout="wide")
-st.title("📬 Monthly Email Theme Selector")
+    content_res = http.put(f"{base_url}/campaigns/{campaign_id}/content", auth=auth, json=campaign_content(draft))
+    if content_res.status_code != 200:
+        raise requests.HTTPError(f"Failed to set campaign content: {content_res.text}", response=content_res)
+    return campaign_id
+
+def submit_mailchimp_batch(operations):
+    base_url, auth = mailchimp_api()
+    for op in operations:
+        op["body"] = json.dumps(op["body"])
+    res = get_http_client().post(f"{base_url}/batches", auth=auth, json={"operations": operations})
+    if res.status_code != 200:
+        raise requests.HTTPError(f"Failed to submit batch: {res.text}", response=res)
+    return res.json()["id"]
+
+def mailchimp_batch_results(batch_id):
+    # None while Mailchimp is still working, else {operation_id: (status_code, response)}
+    import io
+    import tarfile
+    base_url, auth = mailchimp_api()
+    http = get_http_client()
+    res = http.get(f"{base_url}/batches/{batch_id}", auth=auth)
+    if res.status_code != 200:
+        raise requests.HTTPError(f"Failed to check batch {batch_id}: {res.text}", response=res)
+    batch = res.json()
+    if batch["status"] != "finished":
+        return None
+    archive = http.get(batch["response_body_url"])
+    archive.raise_for_status()
+    results = {}
+    with tarfile.open(fileobj=io.BytesIO(archive.content), mode="r:gz") as tar:
+        for member in tar.getmembers():
+            if not member.isfile() or not member.name.endswith(".json"):
+                continue
+            for op in json.load(tar.extractfile(member)):
+                response = json.loads(op["response"]) if op.get("response") else {}
+                results[op["operation_id"]] = (op["status_code"], response)
+    return results
+
+# --- OUTBOX ---
+# SMTP and Mailchimp side effects are queued in a local SQLite job table and run
+# by one background worker per process, with retries and idempotency keys.
+OUTBOX_PATH = os.path.join(".cache", "outbox.sqlite3")
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_SECONDS = 5
+OUTBOX_POLL_SECONDS = 1
+
+def _send_draft_job(payload, progress):
+    send_draft_email_to_shane(payload["subject"], payload["draft"])
+    return "Sent to reviewer"
+
+def _approval_job(payload, progress):
+    send_approval_notification_to_ben(payload["subject"])
+    return "Notification sent"
+
+class RetryLater(Exception):
+    # Raised by a handler that is waiting on something; not counted as a failed attempt
+    def __init__(self, message, delay):
+        super().__init__(message)
+        self.delay = delay
+
+def _store_campaign_ids(campaign_ids, progress):
+    if progress.get("stored_ids") == campaign_ids:
+        return
+    results = batch_update_records({
+        record_id: {MAILCHIMP_CAMPAIGN_FIELD: campaign_id} for record_id, campaign_id in campaign_ids.items()
+    })
+    failed = [record_id for record_id, ok in results.items() if not ok]
+    if failed:
+        raise RuntimeError(f"Failed to store campaign IDs on {', '.join(failed)}")
+    progress["stored_ids"] = dict(campaign_ids)
+
+def _mailchimp_job(payload, progress):
+    campaign_id = create_mailchimp_campaign(
+        payload["subject"], payload["draft"], payload["segment"],
+        progress=progress, campaign_id=payload.get("campaign_id")
+    )
+    _store_campaign_ids({payload["record_id"]: campaign_id}, progress)
+    action = "updated" if payload.get("campaign_id") else "created"
+    return f"Campaign {action} (not sent), ID: {campaign_id}"
+
+def _mailchimp_batch_job(payload, progress):
+    # Phase 1 creates campaigns that don't exist yet; phase 2 sets settings and
+    # content for all of them. Each phase is one Mailchimp batch, polled by retrying.
+    items = payload["items"]
+    campaign_ids = progress.setdefault("campaign_ids", {
+        item["record_id"]: item["campaign_id"] for item in items if item.get("campaign_id")
+    })
+    missing = [item for item in items if item["record_id"] not in campaign_ids]
+    if missing:
+        if "create_batch" not in progress:
+            progress["create_batch"] = submit_mailchimp_batch([
+                {
+                    "method": "POST",
+                    "path": "/campaigns",
+                    "operation_id": item["record_id"],
+                    "body": campaign_data(item["subject"], item["segment"]),
+                }
+                for item in missing
+            ])
+        results = mailchimp_batch_results(progress["create_batch"])
+        if results is None:
+            raise RetryLater(f"Waiting for Mailchimp batch {progress['create_batch']}", MAILCHIMP_BATCH_POLL_SECONDS)
+        failures = []
+        for item in missing:
+            status, response = results.get(item["record_id"], (None, {}))
+            if status != 200:
+                failures.append(f"{item['segment']}: {response or 'no response'}")
+                continue
+            campaign_ids[item["record_id"]] = response["id"]
+        if failures:
+            # Keep the campaigns that were created, and create only the rest on the next attempt
+            del progress["create_batch"]
+            _store_campaign_ids(campaign_ids, progress)
+            raise RuntimeError(f"Failed to create campaigns for {'; '.join(failures)}")
+    _store_campaign_ids(campaign_ids, progress)
+
+    if "content_batch" not in progress:
+        operations = []
+        for item in items:
+            campaign_id = campaign_ids[item["record_id"]]
+            operations.append({
+                "method": "PATCH",
+                "path": f"/campaigns/{campaign_id}",
+                "operation_id": f"settings:{item['record_id']}",
+                "body": {"settings": campaign_settings(item["subject"], item["segment"])},
+            })
+            operations.append({
+                "method": "PUT",
+                "path": f"/campaigns/{campaign_id}/content",
+                "operation_id": f"content:{item['record_id']}",
+                "body": campaign_content(item["draft"]),
+            })
+        progress["content_batch"] = submit_mailchimp_batch(operations)
+    results = mailchimp_batch_results(progress["content_batch"])
+    if results is None:
+        raise RetryLater(f"Waiting for Mailchimp batch {progress['content_batch']}", MAILCHIMP_BATCH_POLL_SECONDS)
+    errors = [op_id for op_id, (status, _) in results.items() if status != 200]
+    if errors:
+        # Start a fresh content batch on the next attempt; campaign IDs are kept
+        del progress["content_batch"]
+        raise RuntimeError(f"Mailchimp batch operations failed: {', '.join(sorted(errors))}")
+    return "Campaigns ready (not sent): " + ", ".join(
+        f"{item['segment']} {campaign_ids[item['record_id']]}" for item in items
+    )
+
+OUTBOX_HANDLERS = {
+    "draft_email": _send_draft_job,
+    "approval_email": _approval_job,
+    "mailchimp_campaign": _mailchimp_job,
+    "mailchimp_batch": _mailchimp_batch_job,
+}
+
+def idempotency_key(kind, record_id, *parts):
+    digest = hashlib.sha256("\x00".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:16]
+    return f"{kind}:{record_id}:{digest}"
+
+class Outbox:
+    def __init__(self, path=OUTBOX_PATH, handlers=OUTBOX_HANDLERS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.handlers = handlers
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, idempotency_key TEXT NOT NULL UNIQUE, "
+                "kind TEXT NOT NULL, label TEXT NOT NULL, payload TEXT NOT NULL, "
+                "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "progress TEXT NOT NULL DEFAULT '{}', result TEXT, last_error TEXT, "
+                "next_attempt_at REAL NOT NULL, created REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            # Jobs left running by a crashed process are picked up again
+            self.conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+
+    def enqueue(self, kind, key, label, payload):
+        # A repeated key is a no-op unless the earlier job failed, in which case it is re-queued
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT status FROM jobs WHERE idempotency_key = ?", (key,)).fetchone()
+            if row is None:
+                self.conn.execute(
+                    "INSERT INTO jobs (idempotency_key, kind, label, payload, status, next_attempt_at, created, updated) "
+                    "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                    (key, kind, label, json.dumps(payload), now, now, now),
+                )
+            elif row[0] == "failed":
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'queued', attempts = 0, next_attempt_at = ?, updated = ? "
+                    "WHERE idempotency_key = ?",
+                    (now, now, key),
+                )
+        self.wake.set()
 
-for segment in ["Pre-Retiree", "Retiree"]:
+    def recent(self, limit=10):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT label, status, attempts, result, last_error, updated FROM jobs "
+                "ORDER BY updated DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        keys = ["label", "status", "attempts", "result", "last_error", "updated"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def claim(self):
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT id, kind, payload, attempts, progress FROM jobs "
+                "WHERE status = 'queued' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row:
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, updated = ? WHERE id = ?",
+                    (now, row[0]),
+                )
+        return row
+
+    def finish(self, job_id, status, progress, result=None, error=None, next_attempt_at=0):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, progress = ?, result = ?, last_error = ?, "
+                "next_attempt_at = ?, updated = ? WHERE id = ?",
+                (status, json.dumps(progress), result, error, next_attempt_at, time.time(), job_id),
+            )
+
+    def run_once(self):
+        job = self.claim()
+        if job is None:
+            return False
+        job_id, kind, payload, attempts, progress = job
+        progress = json.loads(progress)
+        try:
+            with traced_job(f"outbox {kind} #{job_id}"):
+                result = self.handlers[kind](json.loads(payload), progress)
+        except RetryLater as e:
+            with self.lock, self.conn:
+                self.conn.execute("UPDATE jobs SET attempts = attempts - 1 WHERE id = ?", (job_id,))
+            self.finish(job_id, "queued", progress, result=str(e), next_attempt_at=time.time() + e.delay)
+        except Exception as e:
+            attempts += 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                self.finish(job_id, "failed", progress, error=str(e))
+            else:
+                retry_at = time.time() + OUTBOX_RETRY_SECONDS * 2 ** (attempts - 1)
+                self.finish(job_id, "queued", progress, error=str(e), next_attempt_at=retry_at)
+        else:
+            self.finish(job_id, "done", progress, result=result)
+        return True
+
+    def run_forever(self):
+        while True:
+            while self.run_once():
+                pass
+            self.wake.wait(OUTBOX_POLL_SECONDS)
+            self.wake.clear()
+
+    def start(self):
+        threading.Thread(target=self.run_forever, name="outbox-worker", daemon=True).start()
+        return self
+
+@st.cache_resource
+def get_outbox():
+    return Outbox().start()
+
+OUTBOX_STATUS_ICONS = {"queued": "⏳", "running": "🔄", "done": "✅", "failed": "❌"}
+
+@st.fragment(run_every=3)
+def render_outbox_panel():
+    jobs = get_outbox().recent()
+    if not jobs:
+        return
+    st.markdown("### 📮 Outbox")
+    for job in jobs:
+        line = f"{OUTBOX_STATUS_ICONS[job['status']]} {job['label']}"
+        if job["result"]:
+            line += f" · {job['result']}"
+        elif job["last_error"]:
+            line += f" · attempt {job['attempts']}/{OUTBOX_MAX_ATTEMPTS}: {job['last_error']}"
+        st.caption(line)
+
+def render_mirror_status():
+    mirror = get_mirror()
+    last_sync = mirror.meta("last_sync")
+    if last_sync:
+        age = (datetime.now(timezone.utc) - datetime.fromisoformat(last_sync)).total_seconds()
+        st.caption(f"Airtable mirror synced {age:.0f}s ago")
+    if mirror.last_error:
+        st.caption(f"⚠️ Last sync failed: {mirror.last_error}")
+    if action_button("🔄 Resync from Airtable", key="mirror_resync"):
+        try:
+            mirror.sync(full=True)
+        except requests.RequestException as e:
+            st.error(f"Resync failed: {e}")
+
+def render_theme_history(segment):
+    history = [r for r in get_mirror().history(segment) if r["fields"].get("Month") != get_month()]
+    if not history:
+        return
+    with st.expander(f"📜 Past themes for {segment}"):
+        for record in history:
+            st.caption(f"{record['fields'].get('Month')}: {record['fields'].get('Subject')}")
+
+def render_engine_stats():
+    summary = get_draft_engine().summary()
+    for kind, (p50, p95) in summary["percentiles"].items():
+        label = "time to first token" if kind == "stream" else "full draft"
+        st.caption(f"OpenAI {label}: p50 {p50:.1f}s, p95 {p95:.1f}s")
+    attempts = summary["attempts"][-10:][::-1]
+    if attempts:
+        with st.expander(f"Last {len(attempts)} OpenAI attempts"):
+            st.dataframe(
+                [
+                    {"kind": a["kind"], "model": a["model"], "role": a["role"],
+                     "s": round(a["latency"], 2), "outcome": a["outcome"]}
+                    for a in attempts
+                ],
+                hide_index=True,
+            )
+
+def render_diagnostics():
+    if not st.session_state.get("diagnostics"):
+        return
+    st.markdown("### 🔍 Diagnostics")
+    trace_file = get_trace_file()
+    trace_file.background = st.toggle("Trace background jobs", value=trace_file.background)
+    st.caption(f"Trace file: {trace_file.path}")
+    render_engine_stats()
+    groups = [st.session_state["trace_rerun"]] + st.session_state.get("trace_history", [])[::-1]
+    for group in groups:
+        calls = group["calls"]
+        total_ms = sum(c["latency_ms"] for c in calls)
+        title = f"Rerun {group['rerun']} · {group['action'] or 'page load'} · {len(calls)} calls · {total_ms:.0f} ms"
+        with st.expander(title, expanded=group is groups[0]):
+            by_service = {}
+            for call in calls:
+                count, ms = by_service.get(call["service"], (0, 0))
+                by_service[call["service"]] = (count + 1, ms + call["latency_ms"])
+            for service, (count, ms) in sorted(by_service.items(), key=lambda item: -item[1][1]):
+                st.caption(f"{service}: {count} calls, {ms:.0f} ms")
+            if calls:
+                st.dataframe(
+                    [
+                        {
+                            "service": c["service"],
+                            "endpoint": c["endpoint"],
+                            "status": str(c["status"]),
+                            "ms": c["latency_ms"],
+                            "bytes": c["bytes"],
+                            "tokens": sum(c["tokens"][k] for k in ["prompt_tokens", "completion_tokens"]) if c.get("tokens") else None,
+                        }
+                        for c in calls
+                    ],
+                    hide_index=True,
+                )
+
+# --- SEGMENT FRAGMENTS ---
+# Each segment renders as its own fragment, so a click in one segment reruns
+# only that segment. Reads come from the local mirror, which every successful
+# write updates from Airtable's response, so a rerun makes no Airtable calls.
+# A full-app rerun is kept for changes shown outside the segment: the selected
+# theme (variants panel) and approval (the push-all button).
+def fragment_rerun():
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return bool(ctx and ctx.fragment_ids_this_run)
+
+def sync_editor(key, saved):
+    # A keyed widget keeps its own value; reset it when the saved value changes underneath
+    if st.session_state.get(f"{key}_source") != saved:
+        st.session_state[f"{key}_source"] = saved
+        st.session_state[key] = saved
+
+def rerun_segment():
+    # Reruns just the calling segment; a full rerun when called outside a fragment run
+    st.rerun(scope="fragment" if fragment_rerun() else "app")
+
+@st.fragment
+def render_segment(segment):
+    if fragment_rerun():
+        st.session_state["http_calls"] = 0
+        st.session_state["mirror_error"] = None
+        start_trace_rerun()
     st.markdown(f"## {segment}")
+    render_theme_history(segment)
     if f"extra_prompt_{segment}" not in st.session_state:
         st.session_state[f"extra_prompt_{segment}"] = ""
     selected = fetch_selected_theme(segment)
@@ -360,78 +2177,63 @@ for segment in ["Pre-Retiree", "Retiree"]:
     if selected:
         fields = selected["fields"]
         st.success(f"Selected theme: {fields['Subject']} – {fields['Description']}")
-        
+        generation = last_generation(segment)
+        if generation and generation["complete"] and generation["ttft"] is not None:
+            caption = f"Last draft: first token after {generation['ttft']:.1f}s, finished in {generation['total']:.1f}s"
+            if generation["usage"]:
+                usage = generation["usage"]
+                caption += (
+                    f" · {usage['prompt_tokens']:,} prompt tokens ({usage['cached_tokens']:,} cached),"
+                    f" {usage['completion_tokens']:,} completion tokens"
+                )
+            attempts = generation.get("attempts", [])
+            if len(attempts) > 1 or generation.get("model") not in (None, DRAFT_MODEL):
+                caption += f" · {len(attempts)} attempts, answered by {generation['model']}"
+            st.caption(caption)
+    
         if not fields.get("EmailDraft"):
+            repeat = find_repeats(segment, [similarity_documents(selected)["theme"]], "theme")[0]
+            if repeat:
+                st.warning(f"This theme is {repeat_note(repeat)}; consider changing it before drafting.", icon="⚠️")
             st.write("Click below to generate a first draft of your email.")
-            if st.button(f"🪄 Generate Draft for {segment}"):
-                draft = generate_email_draft(fields["Subject"], fields["Description"], segment)
-                update_airtable_fields(selected["id"], {"EmailDraft": draft})
-                st.rerun()
-    
+            if st.session_state.get("use_draft_cache"):
+                st.checkbox("Force fresh draft", key=f"force_fresh_{segment}")
+            if action_button(f"🪄 Generate Draft for {segment}"):
+                draft = generate_draft(build_prompt(fields["Subject"], fields["Description"], segment), segment)
+                # On a failed save the streamed draft stays on screen to copy
+                if draft and update_airtable_fields(selected["id"], {"EmailDraft": draft}):
+                    rerun_segment()
+
         if fields.get("EmailDraft") and not fields.get("DraftApproved"):
             with st.expander("✏️ Add additional instructions and re-generate"):
+                sync_editor(f"prompt_box_{segment}", st.session_state[f"extra_prompt_{segment}"])
                 st.session_state[f"extra_prompt_{segment}"] = st.text_area(
                     "Additional prompt (optional):",
-                    value=st.session_state[f"extra_prompt_{segment}"],
                     key=f"prompt_box_{segment}"
                 )
-                colA, colB, colC, colD = st.columns(4)
-                with colA:
-                    if st.button("➕ Direct Insight", key=f"insight_{segment}"):
-                        st.session_state[f"extra_prompt_{segment}"] += "\nFormat: direct insight"
-                        st.rerun()
-                
-                with colB:
-                    if st.button("➕ Story", key=f"story_{segment}"):
-                        st.session_state[f"extra_prompt_{segment}"] += "\nFormat: story"
-                        st.rerun()
-                
-                with colC:
-                    if st.button("➕ Exercise", key=f"exercise_{segment}"):
-                        st.session_state[f"extra_prompt_{segment}"] += "\nFormat: exercise"
-                        st.rerun()
+                columns = st.columns(4)
+                for i, (label, (key, instruction)) in enumerate(DRAFT_FORMATS.items()):
+                    with columns[i % 4]:
+                        if action_button(f"➕ {label}", key=f"{key}_{segment}"):
+                            st.session_state[f"extra_prompt_{segment}"] += instruction
+                            rerun_segment()
 
-                with colD:
-                    if st.button("➕ Recent Study", key=f"study_{segment}"):
-                        st.session_state[f"extra_prompt_{segment}"] += """\nReference a recent study.
-Do not fabricate data or statistics. Only include references to studies or findings that are plausible and widely reported.
-Avoid citing exact figures (e.g. “63%”) unless you are confident they are accurate and well-established.
-Prefer general phrasing such as “A recent study found…” or “Surveys often show…” Do not mention the reader’s demographic, age, or personal situation—keep the reference broad and relevant to the theme. If you can’t confidently cite a known study, imply a trend without stating specific details."""
-                        st.rerun()
-                
-                colE, colF, colG, colH = st.columns(4)
-                with colE:
-                    if st.button("➕ Myth Buster", key=f"myth_{segment}"):
-                        st.session_state[f"extra_prompt_{segment}"] += "\nFormat: myth buster"
-                        st.rerun()
-                
-                with colF:
-                    if st.button("➕ Case Study", key=f"case_{segment}"):
-                        st.session_state[f"extra_prompt_{segment}"] += "\nFormat: case study"
-                        st.rerun()
-                
-                with colG:
-                    if st.button("➕ Q&A", key=f"qa_{segment}"):
-                        st.session_state[f"extra_prompt_{segment}"] += "\nFormat: Q&A"
-                        st.rerun()
+                full_prompt = build_prompt(
+                    fields["Subject"],
+                    fields["Description"],
+                    segment,
+                    st.session_state[f"extra_prompt_{segment}"]
+                )
+                if st.session_state.get("use_draft_cache"):
+                    render_cached_drafts(full_prompt, segment, selected["id"])
+                    st.checkbox("Force fresh draft", key=f"force_fresh_{segment}")
+
+                if action_button(f"🔁 Re-generate with prompt for {segment}", key=f"regen_{segment}"):
+                    new_draft = generate_draft(full_prompt, segment)
+                    if new_draft and update_airtable_fields(selected["id"], {"EmailDraft": new_draft}):
+                        st.success("Draft regenerated with new prompt.")
+                        rerun_segment()
 
-                if st.button(f"🔁 Re-generate with prompt for {segment}", key=f"regen_{segment}"):
-                    full_prompt = build_prompt(
-                        fields["Subject"],
-                        fields["Description"],
-                        segment,
-                        st.session_state[f"extra_prompt_{segment}"]
-                    )
-                    response = client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[{"role": "user", "content": full_prompt}],
-                        temperature=0.7,
-                    )
-                    new_draft = response.choices[0].message.content.strip()
-                    update_airtable_fields(selected["id"], {"EmailDraft": new_draft})
-                    st.success("Draft regenerated with new prompt.")
-                    st.rerun()
-    
         if fields.get("DraftApproved"):
             st.success("✅ This draft has been approved and is ready to send.")
             st.text_area(
@@ -440,68 +2242,104 @@ Prefer general phrasing such as “A recent study found…” or “Surveys ofte
                 height=300,
                 disabled=True
             )
-            if st.button(f"✏️ Edit Draft Again for {segment}", key=f"editagain_{segment}"):
-                update_airtable_fields(selected["id"], {"DraftApproved": False})
-                st.rerun()
-            if st.button(f"📤 Push to Mailchimp for {segment}", key=f"mailchimp_{segment}"):
-                create_mailchimp_campaign(fields["Subject"], fields["EmailDraft"], segment)
-        
+            if action_button(f"✏️ Edit Draft Again for {segment}", key=f"editagain_{segment}"):
+                if update_airtable_fields(selected["id"], {"DraftApproved": False}):
+                    st.rerun()
+            if action_button(f"📤 Push to Mailchimp for {segment}", key=f"mailchimp_{segment}"):
+                get_outbox().enqueue(
+                    "mailchimp_campaign",
+                    idempotency_key("mailchimp_campaign", selected["id"], fields["Subject"], fields["EmailDraft"]),
+                    f"Mailchimp campaign for {segment}: {fields['Subject']}",
+                    {
+                        "record_id": selected["id"],
+                        "campaign_id": fields.get(MAILCHIMP_CAMPAIGN_FIELD),
+                        "subject": fields["Subject"],
+                        "draft": fields["EmailDraft"],
+                        "segment": segment,
+                    },
+                )
+                st.success("Mailchimp campaign queued. Progress is shown in the sidebar.")
+    
         else:
-            draft = st.text_area("✏️ Edit your draft:", value=fields.get("EmailDraft", ""), height=300, key=f"edit_draft_{segment}")
+            sync_editor(f"edit_draft_{segment}", fields.get("EmailDraft", ""))
+            draft = st.text_area("✏️ Edit your draft:", height=300, key=f"edit_draft_{segment}")
+            if draft:
+                repeat = find_repeats(segment, [draft], "draft")[0]
+                if repeat:
+                    st.warning(f"This draft is {repeat_note(repeat)}; rework it before sending.", icon="⚠️")
+                render_lint_report(draft, segment, selected["id"])
 
             col1, col2, col3 = st.columns(3)
             with col1:
-                if st.button(f"💾 Save Edits for {segment}", key=f"save_{segment}"):
-                    update_airtable_fields(selected["id"], {"EmailDraft": draft})
-                    st.success("Draft saved.")
+                if action_button(f"💾 Save Edits for {segment}", key=f"save_{segment}"):
+                    if update_airtable_fields(selected["id"], {"EmailDraft": draft}):
+                        st.success("Draft saved.")
             with col2:
-                if st.button(f"🔄 Change Theme for {segment}"):
-                    reset_segment_status(segment)
-                    st.rerun()
+                if action_button(f"🔄 Change Theme for {segment}"):
+                    if reset_segment_status(segment):
+                        st.rerun()
+                    st.error("Failed to reset theme status. Please try again.")
             with col3:
                 if fields.get("EmailDraft") and not fields.get("DraftApproved", False):
-                    if st.button(f"📤 Send to Shane for Approval for {segment}",key=f"send_{segment}"):
-                        update_airtable_fields(selected["id"], {"EmailDraft": draft})
-                        update_airtable_fields(selected["id"], {"DraftSubmitted": True})
-                        send_draft_email_to_shane(fields["Subject"], draft)
-                        st.success("Draft sent to Shane for review.")           
-                
-        if not fields.get("DraftApproved") and st.button(f"✅ Mark as Approved for {segment}"):
-            update_airtable_fields(selected["id"], {"DraftApproved": True})
-            send_approval_notification_to_ben(fields["Subject"])
-            st.success("Draft marked as approved and notification sent.")
-            st.rerun()
+                    if action_button(f"📤 Send to Shane for Approval for {segment}",key=f"send_{segment}"):
+                        if update_airtable_fields(selected["id"], {"EmailDraft": draft, "DraftSubmitted": True}):
+                            get_outbox().enqueue(
+                                "draft_email",
+                                idempotency_key("draft_email", selected["id"], fields["Subject"], draft),
+                                f"Review email for {segment}: {fields['Subject']}",
+                                {"subject": fields["Subject"], "draft": draft},
+                            )
+                            st.success("Draft queued to send to Shane for review.")           
+            
+        if not fields.get("DraftApproved") and action_button(f"✅ Mark as Approved for {segment}"):
+            if update_airtable_fields(selected["id"], {"DraftApproved": True}):
+                get_outbox().enqueue(
+                    "approval_email",
+                    idempotency_key("approval_email", selected["id"], fields["Subject"], fields.get("EmailDraft", "")),
+                    f"Approval notification for {segment}: {fields['Subject']}",
+                    {"subject": fields["Subject"]},
+                )
+                st.rerun()
 
     elif skipped:
         st.info("You’ve opted not to send a campaign this month.")
-        if st.button(f"🔁 Change your mind for {segment}"):
-            reset_segment_status(segment)
-            st.rerun()
+        if action_button(f"🔁 Change your mind for {segment}"):
+            if reset_segment_status(segment):
+                rerun_segment()
+            st.error("Failed to reset theme status. Please try again.")
 
     else:
         pending = fetch_pending_themes(segment)
         if not pending:
             st.warning("No pending themes available.")
-            continue
+            return
 
         options = {
             f"{r['fields']['Subject']} – {r['fields']['Description']}": r["id"]
             for r in pending
         }
-        choice = st.radio("Select a theme:", list(options.keys()), key=f"choice_{segment}")
+        # Every pending theme is scored against the segment's history in one pass
+        repeats = find_repeats(segment, [similarity_documents(r)["theme"] for r in pending], "theme")
+        notes = {r["id"]: f"⚠️ {repeat_note(match)}" if match else "" for r, match in zip(pending, repeats)}
+        choice = st.radio(
+            "Select a theme:",
+            list(options.keys()),
+            captions=[notes[record_id] for record_id in options.values()],
+            key=f"choice_{segment}",
+        )
 
         col1, col2 = st.columns(2)
         with col1:
-            if st.button(f"✅ Confirm selection for {segment}"):
-                reset_segment_status(segment)
-                update_status(segment, options[choice])
-                st.rerun()
+            if action_button(f"✅ Confirm selection for {segment}"):
+                if update_status(segment, options[choice]):
+                    st.rerun()
+                st.error("Failed to update theme status. Please try again.")
         with col2:
-            if st.button(f"🚫 Not this month for {segment}"):
-                reset_segment_status(segment)
-                update_status(segment, options[choice])  # skip by reusing one of the record ids
-                update_airtable_fields(options[choice], {"Status": "skipped"})
-                st.rerun()
+            if action_button(f"🚫 Not this month for {segment}"):
+                # skip by reusing one of the record ids
+                if update_status(segment, options[choice], status="skipped"):
+                    rerun_segment()
+                st.error("Failed to update theme status. Please try again.")
 
         # Show manual theme entry only when no selection has been made
         with st.expander(f"➕ Add Manual Theme for {segment}"):
@@ -509,10 +2347,11 @@ Prefer general phrasing such as “A recent study found…” or “Surveys ofte
                 subject = st.text_input("Subject Line", key=f"subject_{segment}")
                 description = st.text_area("Description", key=f"desc_{segment}")
                 if st.form_submit_button("💾 Save Theme"):
+                    name_trace_action(f"💾 Save Theme for {segment}")
                     if not subject or not description:
                         st.error("Please enter both subject and description.")
                     else:
-                        url = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
+                        url = airtable_url()
                         payload = {
                             "fields": {
                                 "Segment": segment,
@@ -522,11 +2361,98 @@ Prefer general phrasing such as “A recent study found…” or “Surveys ofte
                                 "Month": get_month()
                             }
                         }
-                        res = requests.post(url, json={"records": [payload]}, headers=HEADERS)
-                        if res.status_code == 200:
-                            st.success("Manual theme added successfully!")
-                            st.rerun()
+                        count_http_call()
+                        try:
+                            res = get_http_client().post(url, json={"records": [payload]}, headers=airtable_headers())
+                        except requests.RequestException as e:
+                            st.error(f"Failed to add theme: {e}")
                         else:
-                            st.error("Failed to add theme: " + res.text)
+                            if res.status_code == 200:
+                                get_mirror().upsert(res.json().get("records", []))
+                                st.success("Manual theme added successfully!")
+                                rerun_segment()
+                            else:
+                                st.error("Failed to add theme: " + res.text)
+
+# --- HEADLESS USE ---
+# For the command-line scripts that import this module outside `streamlit run`
+# (batch_drafts.py, plan_ahead.py, bench.py).
+THEME_FIELDS = ["Subject", "Description", "Segment", "Month", "Status", "EmailDraft"]
+
+def init_headless(warm_clients=True):
+    global get_mirror
+    import streamlit.logger
+    # Hide the bare-mode warnings
+    streamlit.logger.set_log_level("error")
+    # Keep the local mirror up to date with the writes, without starting its background sync
+    mirror = ThemeMirror()
+
+    def headless_mirror():
+        return mirror
+    get_mirror = headless_mirror
+    if warm_clients:
+        # Build the shared clients once, before workers race to create them or an action is billed for it
+        get_openai_client()
+        get_draft_engine()
+        get_http_client()
+    return mirror
+
+# --- STREAMLIT APP ---
+def main():
+    st.set_page_config(page_title="Monthly Theme Selector", layout="wide")
+    st.title("📬 Monthly Email Theme Selector")
+    st.session_state["http_calls"] = 0
+    st.session_state["mirror_error"] = None
+    st.sidebar.toggle("Use local draft cache", key="use_draft_cache")
+    st.sidebar.toggle("🔍 Diagnostics", key="diagnostics")
+    start_trace_rerun()
+    with st.sidebar:
+        render_mirror_status()
+        render_outbox_panel()
+
+    render_variants_panel(SEGMENTS)
+
+    for segment in SEGMENTS:
+        render_segment(segment)
+
+    approved = []
+    for segment in SEGMENTS:
+        record = fetch_selected_theme(segment)
+        if record and record["fields"].get("DraftApproved"):
+            approved.append((segment, record))
+    if len(approved) > 1:
+        st.markdown("---")
+        if action_button("📤 Push all approved drafts to Mailchimp", key="mailchimp_all"):
+            items = [
+                {
+                    "record_id": record["id"],
+                    "campaign_id": record["fields"].get(MAILCHIMP_CAMPAIGN_FIELD),
+                    "subject": record["fields"]["Subject"],
+                    "draft": record["fields"]["EmailDraft"],
+                    "segment": segment,
+                }
+                for segment, record in approved
+            ]
+            get_outbox().enqueue(
+                "mailchimp_batch",
+                idempotency_key("mailchimp_batch", get_month(), *(f"{i['record_id']}{i['subject']}{i['draft']}" for i in items)),
+                f"Mailchimp campaigns for {', '.join(segment for segment, _ in approved)}",
+                {"items": items},
+            )
+            st.success("Mailchimp batch queued. Progress is shown in the sidebar.")
+
+    st.caption(f"Airtable calls this rerun: {st.session_state['http_calls']}")
+    usage = token_usage_summary()
+    if usage["calls"]:
+        cached_share = usage["cached_tokens"] / usage["prompt_tokens"] if usage["prompt_tokens"] else 0
+        st.caption(
+            f"OpenAI this session: {usage['calls']} calls, {usage['prompt_tokens']:,} prompt tokens "
+            f"({cached_share:.0%} cached), {usage['completion_tokens']:,} completion tokens"
+        )
+
+    with st.sidebar:
+        render_diagnostics()
 
 
+if __name__ == "__main__":
+    main()